@@ -0,0 +1,206 @@
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SEND_PATH = re.compile(r"^/v1/projects/(?P<project_id>[^/]+)/messages:send$")
+TOKEN_PATH = "/token"
+PROJECT_ID = "fcm-benchmark"
+
+# Error responses as FCM returns them: (status code, headers, body)
+RESPONSES = {
+    "unregistered": (404, {}, {
+        "error": {
+            "code": 404,
+            "message": "Requested entity was not found.",
+            "status": "NOT_FOUND",
+            "details": [{
+                "@type": "type.googleapis.com/google.firebase.fcm.v1.FcmError",
+                "errorCode": "UNREGISTERED"
+            }]
+        }
+    }),
+    "rate_limited": (429, {"Retry-After": "{retry_after}"}, {
+        "error": {
+            "code": 429,
+            "message": "Quota exceeded for quota metric 'Messages'.",
+            "status": "RESOURCE_EXHAUSTED",
+            "details": [{
+                "@type": "type.googleapis.com/google.firebase.fcm.v1.FcmError",
+                "errorCode": "QUOTA_EXCEEDED"
+            }]
+        }
+    }),
+    "unavailable": (503, {}, {
+        "error": {
+            "code": 503,
+            "message": "The service is currently unavailable.",
+            "status": "UNAVAILABLE"
+        }
+    }),
+}
+
+class MockFCMServer:
+    """
+    Local stand-in for the FCM v1 `messages:send` and OAuth token endpoints.
+
+    Every request waits `latency` seconds (plus up to `jitter`) before it is
+    answered. `error_mix` maps the keys of RESPONSES to the share of tokens
+    that get that error, e.g. `{"unregistered": 0.05, "unavailable": 0.01}`;
+    all other tokens succeed. The outcome is derived from the token itself,
+    so the same audience fails the same way on every run.
+
+    Use as a context manager:
+
+        with MockFCMServer(latency=0.02) as server:
+            info = server.service_account_info()
+    """
+    def __init__(self, latency=0.02, jitter=0.0, error_mix=None, retry_after=1, token_latency=0.05):
+        unknown = set(error_mix or {}) - set(RESPONSES)
+        if unknown:
+            raise ValueError(f"Unknown error types: {', '.join(sorted(unknown))}")
+        if sum((error_mix or {}).values()) > 1:
+            raise ValueError("The error shares add up to more than 1")
+
+        self.latency = latency
+        self.jitter = jitter
+        self.error_mix = error_mix or {}
+        self.retry_after = retry_after
+        self.token_latency = token_latency
+        self.requests = 0
+        self.token_requests = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="mock-fcm", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def send_url(self):
+        """
+        Drop-in for `transport.FCM_SEND_URL`.
+        """
+        return self.base_url + "/v1/projects/{project_id}/messages:send"
+
+    def service_account_info(self):
+        """
+        Service account JSON whose token endpoint is this server.
+        """
+        return {
+            "type": "service_account",
+            "project_id": PROJECT_ID,
+            "private_key_id": "fcm-benchmark",
+            "private_key": get_private_key(),
+            "client_email": f"benchmark@{PROJECT_ID}.iam.gserviceaccount.com",
+            "client_id": "0",
+            "token_uri": self.base_url + TOKEN_PATH
+        }
+
+    def get_outcome(self, token):
+        # Stable per token, independent of the order requests arrive in
+        share = zlib.crc32((token or "").encode()) % 10000 / 10000
+        for outcome, weight in sorted(self.error_mix.items()):
+            if share < weight:
+                return outcome
+            share -= weight
+        return None
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, like fcm.googleapis.com
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately; do not let Nagle add latency
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+                if self.path == TOKEN_PATH:
+                    with server._lock:
+                        server.token_requests += 1
+                    time.sleep(server.token_latency)
+                    return self.respond(200, {}, {
+                        "access_token": "fcm-benchmark-token",
+                        "expires_in": 3600,
+                        "token_type": "Bearer"
+                    })
+
+                match = SEND_PATH.match(self.path)
+                if not match:
+                    return self.respond(404, {}, {"error": {"code": 404, "status": "NOT_FOUND"}})
+
+                with server._lock:
+                    server.requests += 1
+                time.sleep(server.latency + random.uniform(0, server.jitter))
+
+                message = json.loads(body or b"{}").get("message") or {}
+                outcome = server.get_outcome(message.get("token") or message.get("topic"))
+                if not outcome:
+                    project_id = match.group("project_id")
+                    return self.respond(200, {}, {"name": f"projects/{project_id}/messages/{server.requests}"})
+
+                status_code, headers, payload = RESPONSES[outcome]
+                headers = {key: value.format(retry_after=server.retry_after) for key, value in headers.items()}
+                return self.respond(status_code, headers, payload)
+
+            def respond(self, status_code, headers, payload):
+                data = json.dumps(payload).encode()
+                self.send_response(status_code)
+                self.send_header("Content-Type", "application/json; charset=UTF-8")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+_private_key = None
+
+def get_private_key():
+    """
+    A throwaway RSA key in PEM format, so google-auth can sign the token request.
+    """
+    global _private_key
+
+    if not _private_key:
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        _private_key = key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()
+        ).decode()
+    return _private_key
@@ -0,0 +1,219 @@
+"""
+Benchmark of the FCM send path against a local mock of FCM and Google OAuth.
+
+Needs a site with `allow_tests` enabled (the same guard as `bench run-tests`);
+no network access is used. Run with e.g.
+
+    bench --site test_site execute fcm_notification.benchmarks.send_pipeline.run \\
+        --kwargs "{'audiences': [1, 1000, 10000], 'error_mix': {'unregistered': 0.05}}"
+
+`run` drives `send_fcm_message` end to end: access token, rate limiter,
+concurrent sends, result handling, checkpoints and token pruning.
+`run_sender` times only `send_to_tokens` and needs no site at all.
+"""
+import json
+import statistics
+from contextlib import contextmanager
+from unittest.mock import patch
+
+import frappe
+from frappe.utils import now_datetime
+
+from fcm_notification import circuit_breaker, send_notification, transport as fcm_transport
+from fcm_notification.benchmarks.mock_fcm import MockFCMServer
+from fcm_notification.benchmarks.utils import (
+    check_site,
+    create_devices,
+    delete_devices,
+    get_token,
+    measure,
+    percentile,
+    report
+)
+from fcm_notification.oauth import clear_access_token_cache
+from fcm_notification.sender import DEFAULT_CONCURRENCY, classify_result, send_to_tokens
+from fcm_notification.transport import FCMTransport, get_headers
+
+DEFAULT_AUDIENCES = (1, 100, 1000, 10000, 100000)
+REPORT_COLUMNS = ("audience", "seconds", "sends_per_second", "p50_ms", "p99_ms", "peak_memory_mb", "outcomes")
+
+# Circuits are shared by every site on the Redis; errors from the mock must
+# never open the real ones
+BENCHMARK_CIRCUIT_KEY = "fcm_notification:benchmark_circuit:{name}"
+
+def run(audiences=DEFAULT_AUDIENCES, latency=0.02, jitter=0.0, error_mix=None, concurrency=DEFAULT_CONCURRENCY,
+        rate_limit=0, use_http2=False, trace_memory=True, output=None):
+    """
+    Benchmark `send_fcm_message` for each audience size and print a report.
+
+    Args:
+        audiences (list): numbers of device tokens to send one notification to
+        latency (float): seconds the mock FCM takes to answer each send
+        jitter (float): up to this many seconds are added to `latency`
+        error_mix (dict): share of tokens per error type, see MockFCMServer
+        concurrency (int): Max Concurrency used for the run
+        rate_limit (float): Rate Limit used for the run, 0 for none
+        use_http2 (bool): send over HTTP/2 instead of HTTP/1.1
+        trace_memory (bool): measure peak Python memory with tracemalloc,
+            which also slows down the run
+        output (str): also write the results as JSON to this path
+
+    Returns:
+        list: one dict of results per audience size
+    """
+    check_site()
+
+    results = []
+    with MockFCMServer(latency=latency, jitter=jitter, error_mix=error_mix) as server, \
+            benchmark_settings(server, concurrency, rate_limit, use_http2), \
+            patch.object(fcm_transport, "FCM_SEND_URL", server.send_url):
+        for audience in audiences:
+            try:
+                results.append(benchmark_notification(int(audience), trace_memory))
+            finally:
+                cleanup()
+
+    report(results, REPORT_COLUMNS, output)
+    return results
+
+def run_sender(audiences=DEFAULT_AUDIENCES, latency=0.02, jitter=0.0, error_mix=None,
+               concurrency=DEFAULT_CONCURRENCY, use_http2=False, trace_memory=True, output=None):
+    """
+    Benchmark `send_to_tokens` alone: HTTP, threading and result handling,
+    without the database, Redis or OAuth.
+    """
+    results = []
+    with MockFCMServer(latency=latency, jitter=jitter, error_mix=error_mix) as server:
+        transport = FCMTransport(pool_size=concurrency, http2=use_http2)
+        url = server.send_url.format(project_id="fcm-benchmark")
+        headers = get_headers("fcm-benchmark-token")
+        try:
+            for audience in audiences:
+                tokens = (get_token(i) for i in range(int(audience)))
+                latencies, outcomes = [], {}
+
+                with measure(trace_memory) as measured:
+                    for result in send_to_tokens(transport, url, headers, build_message, tokens, concurrency):
+                        latencies.append(result.elapsed)
+                        outcome = classify_result(result)
+                        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+                results.append(summarize(int(audience), measured, latencies, outcomes))
+        finally:
+            transport.close()
+
+    report(results, REPORT_COLUMNS, output)
+    return results
+
+def benchmark_notification(audience, trace_memory):
+    devices = create_devices(audience)
+    doc = create_notification(devices)
+
+    latencies = []
+
+    def recording_send_to_tokens(*args, **kwargs):
+        for result in send_to_tokens(*args, **kwargs):
+            latencies.append(result.elapsed)
+            yield result
+
+    with patch.object(send_notification, "send_to_tokens", recording_send_to_tokens), \
+            measure(trace_memory) as measured:
+        send_notification.send_fcm_message(doc)
+
+    doc.reload()
+    return summarize(audience, measured, latencies, {
+        "sent": doc.sent_count,
+        "failed": doc.failed_count,
+        "pruned": doc.pruned_count,
+        "status": doc.status
+    })
+
+@contextmanager
+def benchmark_settings(server, concurrency, rate_limit, use_http2):
+    """
+    Point FCM Notification Settings at the mock server for the duration of
+    the run, and record outcomes in circuits of its own.
+    """
+    values = {
+        "server_key": json.dumps(server.service_account_info()),
+        "max_concurrency": concurrency,
+        "pool_size": concurrency,
+        "rate_limit": rate_limit,
+        "use_http2": int(bool(use_http2)),
+    }
+    original = {
+        fieldname: frappe.db.get_single_value("FCM Notification Settings", fieldname)
+        for fieldname in values
+    }
+
+    set_settings(values)
+    clear_benchmark_circuits()
+    try:
+        with patch.object(circuit_breaker, "CIRCUIT_KEY", BENCHMARK_CIRCUIT_KEY):
+            yield
+    finally:
+        clear_benchmark_circuits()
+        set_settings(original)
+
+def set_settings(values):
+    frappe.db.set_single_value("FCM Notification Settings", values)
+    frappe.clear_document_cache("FCM Notification Settings", "FCM Notification Settings")
+    clear_access_token_cache()
+    frappe.db.commit()
+
+def clear_benchmark_circuits():
+    for name in circuit_breaker.CIRCUITS:
+        frappe.cache().execute_command("DEL", BENCHMARK_CIRCUIT_KEY.format(name=name))
+
+def create_notification(devices):
+    # Inserted as claimed by a dispatcher, so no delivery job is queued for it
+    doc = frappe.get_doc({
+        "doctype": "FCM Notification",
+        "subject": "FCM benchmark",
+        "message": "Benchmark message",
+        "status": "CLAIMED",
+        "attempts": 1,
+    }).insert(ignore_permissions=True)
+
+    now = now_datetime()
+    frappe.db.bulk_insert(
+        "FCM Notification Recipient",
+        ["name", "creation", "modified", "owner", "modified_by", "parent", "parenttype", "parentfield", "idx",
+         "user_device", "user", "device_token"],
+        [
+            (f"{doc.name}-{idx}", now, now, "Administrator", "Administrator", doc.name, "FCM Notification",
+             "recipients", idx, device.name, device.user, device.device_token)
+            for idx, device in enumerate(devices, 1)
+        ]
+    )
+    frappe.db.commit()
+    return frappe.get_doc("FCM Notification", doc.name)
+
+def cleanup():
+    frappe.db.rollback()
+    notifications = frappe.get_all("FCM Notification", filters={"subject": "FCM benchmark"}, pluck="name")
+    if notifications:
+        frappe.db.delete("FCM Notification Recipient", {"parent": ["in", notifications]})
+        frappe.db.delete("FCM Notification", {"name": ["in", notifications]})
+    delete_devices()
+
+def summarize(audience, measured, latencies, outcomes):
+    latencies = sorted(latencies)
+    return {
+        "audience": audience,
+        "seconds": round(measured["seconds"], 3),
+        "sends_per_second": round(len(latencies) / measured["seconds"], 1) if measured["seconds"] else 0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 2) if latencies else 0,
+        "peak_memory_mb": round(measured["peak_memory_mb"], 2) if "peak_memory_mb" in measured else None,
+        "outcomes": outcomes
+    }
+
+def build_message(token):
+    return {
+        "message": {
+            "notification": {"title": "FCM benchmark", "body": "Benchmark message"},
+            "token": token
+        }
+    }
@@ -0,0 +1,82 @@
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import frappe
+from frappe.utils import now_datetime
+
+# Benchmark rows are named with this prefix and removed afterwards
+ROW_PREFIX = "fcm-bench-"
+
+def check_site():
+    if not frappe.conf.allow_tests:
+        frappe.throw("Benchmarks write and delete records; enable allow_tests for this site first.")
+
+def get_token(i):
+    return f"fcm-benchmark-token-{i:08d}"
+
+def create_devices(count, user="Administrator"):
+    """
+    Bulk insert `count` User Devices of `user` and return them as dicts.
+    """
+    now = now_datetime()
+    devices = [
+        frappe._dict(name=f"{ROW_PREFIX}{i}", user=user, device_token=get_token(i))
+        for i in range(count)
+    ]
+    frappe.db.bulk_insert(
+        "User Device",
+        ["name", "creation", "modified", "owner", "modified_by", "user", "device_token", "device_id", "platform"],
+        [
+            (device.name, now, now, "Administrator", "Administrator", device.user, device.device_token,
+             device.name, "android")
+            for device in devices
+        ]
+    )
+    frappe.db.commit()
+    return devices
+
+def delete_devices():
+    frappe.db.delete("User Device", {"name": ["like", f"{ROW_PREFIX}%"]})
+    frappe.db.commit()
+
+@contextmanager
+def measure(trace_memory=False):
+    """
+    Time the block and, with `trace_memory`, record its peak Python memory.
+    """
+    measured = {}
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        yield measured
+    finally:
+        measured["seconds"] = time.perf_counter() - started
+        if trace_memory:
+            measured["peak_memory_mb"] = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+            tracemalloc.stop()
+
+def percentile(values, percent):
+    """
+    Nearest-rank percentile of the sorted list `values`.
+    """
+    if not values:
+        return 0
+    return values[max(int(round(percent / 100 * len(values))) - 1, 0)]
+
+def report(results, columns, output=None):
+    """
+    Print `results` as a table and optionally write them as JSON to `output`.
+    """
+    print("  ".join(f"{column:>16}" for column in columns))
+    for result in results:
+        print("  ".join(
+            f"{json.dumps(value) if isinstance(value, dict) else str(value):>16}"
+            for value in (result.get(column) for column in columns)
+        ))
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=1, default=str)
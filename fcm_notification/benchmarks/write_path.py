@@ -0,0 +1,269 @@
+"""
+Benchmark of the latency and queries the "*" doc_events hooks add to writes.
+
+Every insert, save and submit on the site runs `process_document_for_fcm`.
+This drives batches of writes with the hook enabled and with it replaced by
+a no-op, for sites with no, one and many FCM rules, complex conditions and
+large recipient lists, and reports the difference per write.
+
+Needs a site with `allow_tests` enabled. All writes are rolled back; the
+benchmark doctype, rules and devices are removed afterwards. Run with e.g.
+
+    bench --site test_site execute fcm_notification.benchmarks.write_path.run \\
+        --kwargs "{'writes': 500, 'scenarios': ['no_rules', 'many_rules']}"
+"""
+import statistics
+import time
+from contextlib import contextmanager
+from unittest.mock import patch
+
+import frappe
+from frappe.utils import now_datetime
+
+from fcm_notification import send_notification
+from fcm_notification.benchmarks.utils import (
+    ROW_PREFIX,
+    check_site,
+    create_devices,
+    delete_devices,
+    percentile,
+    report
+)
+from fcm_notification.rules import invalidate_rules_cache
+
+BENCHMARK_DOCTYPE = "FCM Benchmark Document"
+
+SIMPLE_CONDITION = 'doc.status == "Open"'
+COMPLEX_CONDITION = (
+    'doc.status in ("Open", "Pending") and flt(doc.amount) > 100 and len(cstr(doc.title)) > 3 '
+    'and not cstr(doc.title).startswith("x") and any(word in cstr(doc.title) for word in ("urgent", "bench")) '
+    'and date_diff(nowdate(), getdate(doc.creation)) < 30'
+)
+NON_MATCHING_CONDITION = 'doc.status == "Closed"'
+
+# name: (number of rules, rule condition, devices of the recipient)
+SCENARIOS = {
+    "no_rules": (0, None, 1),
+    "one_rule": (1, SIMPLE_CONDITION, 1),
+    "many_rules": (25, SIMPLE_CONDITION, 1),
+    "non_matching_rules": (25, NON_MATCHING_CONDITION, 1),
+    "complex_conditions": (5, COMPLEX_CONDITION, 1),
+    "large_recipient_list": (1, SIMPLE_CONDITION, 1000),
+}
+OPERATIONS = ("insert", "save", "submit", "insert_without_rules")
+WARMUP_WRITES = 10
+
+REPORT_COLUMNS = (
+    "scenario", "operation", "disabled_ms", "enabled_ms", "added_ms", "added_p99_ms",
+    "disabled_queries", "enabled_queries", "added_queries"
+)
+
+def run(writes=200, scenarios=None, operations=OPERATIONS, output=None):
+    """
+    Benchmark the write-path overhead of the FCM hooks and print a report.
+
+    Args:
+        writes (int): measured writes per scenario, operation and mode
+        scenarios (list): names from SCENARIOS, all of them by default
+        operations (list): any of "insert", "save" and "submit" on the
+            benchmark doctype, and "insert_without_rules" on ToDo
+        output (str): also write the results as JSON to this path
+
+    Returns:
+        list: one dict of results per scenario and operation
+    """
+    check_site()
+    writes = int(writes)
+
+    results = []
+    create_benchmark_doctype()
+    try:
+        for scenario in scenarios or SCENARIOS:
+            rules, condition, devices = SCENARIOS[scenario]
+            setup_scenario(rules, condition, devices)
+            try:
+                for operation in operations:
+                    disabled = time_writes(operation, writes, enabled=False)
+                    enabled = time_writes(operation, writes, enabled=True)
+                    results.append(compare(scenario, operation, disabled, enabled))
+            finally:
+                teardown_scenario()
+    finally:
+        drop_benchmark_doctype()
+
+    report(results, REPORT_COLUMNS, output)
+    return results
+
+def time_writes(operation, writes, enabled):
+    """
+    Return the latency (seconds) and query count of each of `writes` writes.
+    """
+    prepare, write = get_operation(operation)
+    hook = send_notification.process_document_for_fcm if enabled else _skip_hook
+
+    latencies, queries = [], []
+    try:
+        with patch.object(send_notification, "process_document_for_fcm", hook), count_queries() as counter:
+            docs = [prepare(i) for i in range(writes + WARMUP_WRITES)]
+            for i, doc in enumerate(docs):
+                count, started = counter["queries"], time.perf_counter()
+                write(doc)
+                if i >= WARMUP_WRITES:
+                    latencies.append(time.perf_counter() - started)
+                    queries.append(counter["queries"] - count)
+    finally:
+        # Nothing is committed, so no delivery job is queued either
+        frappe.db.rollback()
+
+    return latencies, queries
+
+def get_operation(operation):
+    """
+    Return `(prepare, write)` for `operation`; only `write` is timed.
+    """
+    def new_doc(i):
+        return frappe.get_doc({
+            "doctype": BENCHMARK_DOCTYPE,
+            "title": f"bench {i} urgent",
+            "status": "Open",
+            "amount": 500
+        })
+
+    def inserted_doc(i):
+        with patch.object(send_notification, "process_document_for_fcm", _skip_hook):
+            return new_doc(i).insert(ignore_permissions=True)
+
+    def save(doc):
+        doc.amount = doc.amount + 1
+        doc.save(ignore_permissions=True)
+
+    operations = {
+        "insert": (new_doc, lambda doc: doc.insert(ignore_permissions=True)),
+        "save": (inserted_doc, save),
+        "submit": (inserted_doc, lambda doc: doc.submit()),
+        "insert_without_rules": (
+            lambda i: frappe.get_doc({"doctype": "ToDo", "description": f"FCM benchmark {i}"}),
+            lambda doc: doc.insert(ignore_permissions=True)
+        ),
+    }
+    return operations[operation]
+
+def compare(scenario, operation, disabled, enabled):
+    disabled_latencies, disabled_queries = disabled
+    enabled_latencies, enabled_queries = enabled
+
+    def ms(seconds):
+        return round(seconds * 1000, 3)
+
+    disabled_mean = statistics.fmean(disabled_latencies) if disabled_latencies else 0
+    enabled_mean = statistics.fmean(enabled_latencies) if enabled_latencies else 0
+    disabled_query_mean = statistics.fmean(disabled_queries) if disabled_queries else 0
+    enabled_query_mean = statistics.fmean(enabled_queries) if enabled_queries else 0
+    return {
+        "scenario": scenario,
+        "operation": operation,
+        "writes": len(enabled_latencies),
+        "disabled_ms": ms(disabled_mean),
+        "enabled_ms": ms(enabled_mean),
+        "added_ms": ms(enabled_mean - disabled_mean),
+        "added_p50_ms": ms(percentile(sorted(enabled_latencies), 50) - percentile(sorted(disabled_latencies), 50)),
+        "added_p99_ms": ms(percentile(sorted(enabled_latencies), 99) - percentile(sorted(disabled_latencies), 99)),
+        "disabled_queries": round(disabled_query_mean, 2),
+        "enabled_queries": round(enabled_query_mean, 2),
+        "added_queries": round(enabled_query_mean - disabled_query_mean, 2)
+    }
+
+@contextmanager
+def count_queries():
+    """
+    Count the SQL queries run inside the block.
+    """
+    counter = {"queries": 0}
+    sql = frappe.local.db.sql
+
+    def counting_sql(*args, **kwargs):
+        counter["queries"] += 1
+        return sql(*args, **kwargs)
+
+    with patch.object(frappe.local.db, "sql", counting_sql):
+        yield counter
+
+def setup_scenario(rules, condition, devices):
+    if devices:
+        create_devices(devices)
+
+    now = now_datetime()
+    for i in range(rules):
+        rule = frappe.get_doc({
+            "doctype": "Notification",
+            "name": f"{ROW_PREFIX}rule-{i}",
+            "subject": "{{ doc.title }} changed",
+            "message": "{{ doc.title }} is {{ doc.status }} ({{ doc.amount }})",
+            "document_type": BENCHMARK_DOCTYPE,
+            "event": "Save",
+            "channel": "FCM",
+            "enabled": 1,
+            "condition": condition,
+            "creation": now,
+            "modified": now,
+            "owner": "Administrator"
+        })
+        # Skip Notification validation, which does not know the FCM channel
+        rule.db_insert()
+        recipient = frappe.get_doc({
+            "doctype": "Notification Recipient",
+            "name": f"{rule.name}-recipient",
+            "parent": rule.name,
+            "parenttype": "Notification",
+            "parentfield": "recipients",
+            "idx": 1,
+            "receiver_by_role": "System Manager",
+            "creation": now,
+            "modified": now,
+            "owner": "Administrator"
+        })
+        recipient.db_insert()
+
+    invalidate_rules_cache()
+    frappe.db.commit()
+
+def teardown_scenario():
+    frappe.db.delete("Notification Recipient", {"parent": ["like", f"{ROW_PREFIX}%"]})
+    frappe.db.delete("Notification", {"name": ["like", f"{ROW_PREFIX}%"]})
+    invalidate_rules_cache()
+    delete_devices()
+
+def create_benchmark_doctype():
+    if frappe.db.exists("DocType", BENCHMARK_DOCTYPE):
+        return
+
+    frappe.get_doc({
+        "doctype": "DocType",
+        "name": BENCHMARK_DOCTYPE,
+        "module": "Fcm Notification",
+        "custom": 1,
+        "is_submittable": 1,
+        "autoname": "hash",
+        "fields": [
+            {"fieldname": "title", "fieldtype": "Data", "label": "Title"},
+            {"fieldname": "status", "fieldtype": "Select", "label": "Status", "options": "Open\nPending\nClosed"},
+            {"fieldname": "amount", "fieldtype": "Currency", "label": "Amount"}
+        ],
+        "permissions": [{
+            "role": "System Manager",
+            "read": 1,
+            "write": 1,
+            "create": 1,
+            "submit": 1,
+            "cancel": 1,
+            "delete": 1
+        }]
+    }).insert(ignore_permissions=True)
+    frappe.db.commit()
+
+def drop_benchmark_doctype():
+    frappe.delete_doc("DocType", BENCHMARK_DOCTYPE, force=True, ignore_permissions=True)
+    frappe.db.commit()
+
+def _skip_hook(doc, method=None):
+    pass
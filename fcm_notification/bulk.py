@@ -0,0 +1,210 @@
+from contextlib import contextmanager
+
+import frappe
+from frappe.utils import cint
+
+from fcm_notification import metrics
+from fcm_notification.digest import get_collapse_key, get_digest_content
+from fcm_notification.recipients import get_user_devices
+from fcm_notification.rules import get_compiled_rule, get_rules
+
+# Frappe flags marking bulk writes; rules are evaluated once they are done
+BULK_FLAGS = ("in_import", "in_migrate", "in_patch")
+
+# Per-rule choice (Notification.fcm_bulk_action) for documents written in bulk
+BULK_SEND = "Send"
+BULK_DIGEST = "Digest"
+BULK_SUPPRESS = "Suppress"
+DEFAULT_BULK_ACTION = BULK_DIGEST
+
+# Digest window for rules without one of their own
+BULK_DIGEST_WINDOW = 300
+# Touched documents are read in pages of this size
+BULK_BATCH_SIZE = 500
+
+def in_bulk_operation():
+    """
+    Whether document events should be recorded instead of evaluated.
+    """
+    return bool(frappe.flags.fcm_bulk_operation or any(frappe.flags.get(flag) for flag in BULK_FLAGS))
+
+@contextmanager
+def bulk_operation():
+    """
+    Defer FCM rules for all documents written inside the block.
+
+    The rules run once for every touched document when the block exits,
+    within the caller's transaction. Nothing is sent if the block raises.
+
+        with bulk_operation():
+            for row in rows:
+                frappe.get_doc(row).insert()
+    """
+    outer = frappe.flags.fcm_bulk_operation
+    frappe.flags.fcm_bulk_operation = True
+    try:
+        yield
+    except Exception:
+        if not outer:
+            frappe.flags.pop("fcm_touched_documents", None)
+            frappe.flags.pop("fcm_uncommitted_documents", None)
+        raise
+    finally:
+        frappe.flags.fcm_bulk_operation = outer
+
+    if not outer:
+        process_touched_documents()
+
+def record_touched_document(doc):
+    """
+    Remember `doc` for the rule pass after the bulk operation.
+
+    The document only counts as touched once the transaction commits; a
+    rollback forgets it, so nothing is sent for changes that never happened.
+    """
+    key = (doc.doctype, doc.name)
+    if key in frappe.flags.get("fcm_touched_documents", {}):
+        return
+
+    uncommitted = frappe.flags.get("fcm_uncommitted_documents")
+    if uncommitted is None:
+        uncommitted = frappe.flags.fcm_uncommitted_documents = {}
+        frappe.db.after_commit.add(commit_touched_documents)
+        frappe.db.after_rollback.add(discard_uncommitted_documents)
+
+    if key not in uncommitted:
+        uncommitted[key] = True
+        metrics.incr("bulk_documents_deferred")
+
+def commit_touched_documents():
+    uncommitted = frappe.flags.pop("fcm_uncommitted_documents", None)
+    if uncommitted:
+        frappe.flags.setdefault("fcm_touched_documents", {}).update(uncommitted)
+
+def discard_uncommitted_documents():
+    frappe.flags.pop("fcm_uncommitted_documents", None)
+
+def flush_touched_documents(**kwargs):
+    """
+    Hook (after_request, after_job, after_migrate): run the rules for the
+    documents an import, patch or migration touched, and commit.
+
+    A failed request or job was rolled back before this runs, which already
+    forgot its documents.
+    """
+    if not frappe.flags.get("fcm_touched_documents") and not frappe.flags.get("fcm_uncommitted_documents"):
+        return
+
+    try:
+        process_touched_documents()
+        frappe.db.commit()
+    except Exception:
+        frappe.db.rollback()
+        frappe.log_error("Error processing FCM rules after a bulk operation", "FCM Notification Error")
+
+def process_touched_documents():
+    """
+    Evaluate the FCM rules for all recorded documents in one pass, including
+    those not committed yet when called inside the bulk operation's
+    transaction.
+
+    Documents are read per doctype in pages and recipients' devices are
+    looked up once per rule and page. Each rule then sends, digests or
+    suppresses the pushes according to its Bulk Action.
+    """
+    touched = frappe.flags.pop("fcm_touched_documents", None) or {}
+    touched.update(frappe.flags.pop("fcm_uncommitted_documents", None) or {})
+    if not touched:
+        return
+
+    names_by_doctype = {}
+    for doctype, name in touched:
+        names_by_doctype.setdefault(doctype, []).append(name)
+
+    # Broadcast rules in Digest mode send one summary for the whole operation
+    broadcasts = {}
+    for doctype, names in names_by_doctype.items():
+        rules = [rule for rule in get_rules(doctype) if get_bulk_action(rule) != BULK_SUPPRESS]
+        if not rules:
+            continue
+
+        for start in range(0, len(names), BULK_BATCH_SIZE):
+            docs = get_documents(doctype, names[start:start + BULK_BATCH_SIZE])
+            for rule in rules:
+                try:
+                    process_rule(rule, docs, broadcasts)
+                except Exception as e:
+                    frappe.log_error(
+                        f"Error processing FCM notification {rule.name} for {len(docs)} {doctype} documents: {e}",
+                        "FCM Notification Error"
+                    )
+
+    for rule, items, reference_doc in broadcasts.values():
+        send_broadcast_digest(rule, items, reference_doc)
+
+def process_rule(rule, docs, broadcasts):
+    from fcm_notification.send_notification import get_rule_users, notify_all_users, notify_devices
+
+    compiled = get_compiled_rule(rule)
+    matched = []
+    for doc in docs:
+        metrics.incr("rules_evaluated")
+        if compiled.matches(doc):
+            metrics.incr("rules_matched")
+            matched.append((doc, *compiled.render(doc), get_rule_users(rule, doc)))
+    if not matched:
+        return
+
+    action = get_bulk_action(rule)
+    digest_window = cint(rule.get("fcm_digest_window"))
+    if action == BULK_DIGEST:
+        digest_window = digest_window or BULK_DIGEST_WINDOW
+
+    # Devices of every recipient of this page, in one query
+    devices_by_user = {}
+    for device in get_user_devices(list({user for *_, users in matched for user in users or []})):
+        devices_by_user.setdefault(device.user, []).append(device)
+
+    for doc, subject, message, users in matched:
+        if users is None:
+            if action == BULK_SEND:
+                notify_all_users(rule, doc, subject, message)
+            else:
+                entry = broadcasts.setdefault(rule.name, (rule, [], doc))
+                entry[1].append({"subject": subject, "message": message})
+        elif users:
+            devices = [device for user in dict.fromkeys(users) for device in devices_by_user.get(user, [])]
+            notify_devices(rule, doc, subject, message, devices, digest_window)
+
+def send_broadcast_digest(rule, items, reference_doc):
+    """
+    Create a single "All users" FCM Notification summarizing `items`.
+    """
+    from fcm_notification.send_notification import create_fcm_notification
+
+    subject, message = get_digest_content(items)
+    create_fcm_notification(
+        subject,
+        message,
+        all_users=True,
+        reference_doc=reference_doc,
+        collapse_key=get_collapse_key(rule.name),
+        digest_count=len(items),
+        priority=rule.get("fcm_priority")
+    )
+    metrics.incr("digest_sends_saved", len(items) - 1)
+
+def get_documents(doctype, names):
+    """
+    Read the documents `names` of `doctype` in one query.
+
+    Documents deleted meanwhile are skipped. Rule conditions and templates
+    see the document's own fields; child tables are not loaded.
+    """
+    docs = frappe.get_all(doctype, filters={"name": ["in", names]}, fields=["*"])
+    for doc in docs:
+        doc.doctype = doctype
+    return docs
+
+def get_bulk_action(rule):
+    return rule.get("fcm_bulk_action") or DEFAULT_BULK_ACTION
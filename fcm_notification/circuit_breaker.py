@@ -0,0 +1,244 @@
+import time
+
+import frappe
+from frappe.utils import cint, flt
+
+from fcm_notification import metrics
+
+# Defaults, overridable in FCM Notification Settings
+DEFAULT_FAILURE_RATE = 50
+DEFAULT_MIN_REQUESTS = 20
+# Token refreshes are rare and serialized, so a few failures must be enough
+DEFAULT_OAUTH_MIN_REQUESTS = 3
+DEFAULT_WINDOW = 60
+DEFAULT_OPEN_SECONDS = 30
+
+# Outcomes are pushed to Redis after this many requests or seconds,
+# and right away for a half-open probe
+FLUSH_EVERY = 20
+FLUSH_INTERVAL = 1
+
+# Like the rate limiter, not prefixed with the site: an endpoint outage hits
+# every site and worker sharing this Redis
+CIRCUIT_KEY = "fcm_notification:circuit:{name}"
+CIRCUITS = ("fcm", "oauth")
+
+# Returns "closed" or "probe" when the caller may send, otherwise the
+# seconds until it may try again. While open, one probe at a time is let
+# through once `open_seconds` have passed.
+ALLOW_SCRIPT = """
+local open_seconds = tonumber(ARGV[1])
+
+local clock = redis.call("TIME")
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+
+local state = redis.call("HMGET", KEYS[1], "opened_at", "probe_until")
+local opened_at = tonumber(state[1])
+if not opened_at then
+    return "closed"
+end
+if now < opened_at + open_seconds then
+    return tostring(opened_at + open_seconds - now)
+end
+
+local probe_until = tonumber(state[2])
+if probe_until and now < probe_until then
+    return tostring(probe_until - now)
+end
+redis.call("HSET", KEYS[1], "probe_until", now + open_seconds)
+return "probe"
+"""
+
+# Adds outcomes to the current window and opens the circuit when the failure
+# rate is reached. While open, only the outcome of a probe counts: success
+# closes the circuit, failure opens it again.
+# Returns "closed", "open", "opened" or "reopened".
+RECORD_SCRIPT = """
+local successes = tonumber(ARGV[1])
+local failures = tonumber(ARGV[2])
+local window = tonumber(ARGV[3])
+local failure_rate = tonumber(ARGV[4])
+local min_requests = tonumber(ARGV[5])
+local probe = tonumber(ARGV[6])
+
+local clock = redis.call("TIME")
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+
+local state = redis.call("HMGET", KEYS[1], "opened_at", "window_start", "successes", "failures")
+if tonumber(state[1]) then
+    if probe == 0 then
+        return "open"
+    end
+    if failures > 0 then
+        redis.call("HSET", KEYS[1], "opened_at", now)
+        redis.call("HDEL", KEYS[1], "probe_until")
+        return "reopened"
+    end
+    redis.call("DEL", KEYS[1])
+    return "closed"
+end
+
+local window_start = tonumber(state[2]) or now
+local ok = tonumber(state[3]) or 0
+local failed = tonumber(state[4]) or 0
+if now - window_start > window then
+    window_start, ok, failed = now, 0, 0
+end
+ok = ok + successes
+failed = failed + failures
+
+if ok + failed >= min_requests and failed * 100 >= failure_rate * (ok + failed) then
+    redis.call("DEL", KEYS[1])
+    redis.call("HSET", KEYS[1], "opened_at", now, "successes", ok, "failures", failed)
+    redis.call("EXPIRE", KEYS[1], 86400)
+    return "opened"
+end
+
+redis.call("HSET", KEYS[1], "window_start", window_start, "successes", ok, "failures", failed)
+redis.call("EXPIRE", KEYS[1], window * 2)
+return "closed"
+"""
+
+class CircuitOpen(Exception):
+    def __init__(self, name, retry_after):
+        super().__init__(f"FCM circuit {name} is open, retry in {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    """
+    Failure-rate circuit breaker shared by every worker through Redis.
+
+    Callers ask `allow` before using the endpoint and `record` each
+    outcome. Once `failure_rate` percent of at least `min_requests` requests
+    within `window` seconds failed, the circuit opens and `allow` raises
+    CircuitOpen for `open_seconds`. After that, a single caller is let
+    through as a probe; its outcome closes or reopens the circuit.
+    """
+    def __init__(self, name, failure_rate=DEFAULT_FAILURE_RATE, min_requests=DEFAULT_MIN_REQUESTS,
+                 window=DEFAULT_WINDOW, open_seconds=DEFAULT_OPEN_SECONDS):
+        self.name = name
+        self.key = CIRCUIT_KEY.format(name=name)
+        self.failure_rate = failure_rate
+        self.min_requests = min_requests
+        self.window = window
+        self.open_seconds = open_seconds
+
+        cache = frappe.cache()
+        self.allow_script = cache.register_script(ALLOW_SCRIPT)
+        self.record_script = cache.register_script(RECORD_SCRIPT)
+
+        self.probe = False
+        self.successes = self.failures = 0
+        self.flushed_at = time.monotonic()
+        # Once the circuit is known to be open, refuse locally until it may close
+        self.open_until = 0
+
+    def allow(self):
+        """
+        Raise CircuitOpen unless requests may be sent.
+        """
+        self.check()
+        state = frappe.safe_decode(self.allow_script(keys=[self.key], args=[self.open_seconds]))
+        if state == "probe":
+            self.probe = True
+        elif state != "closed":
+            self._refuse(float(state))
+
+    def check(self):
+        """
+        Raise CircuitOpen if this breaker saw the circuit open; no Redis call.
+        """
+        if self.open_until > time.monotonic():
+            raise CircuitOpen(self.name, self.open_until - time.monotonic())
+
+    def record(self, success):
+        if success:
+            self.successes += 1
+        else:
+            self.failures += 1
+
+        if (self.probe or self.successes + self.failures >= FLUSH_EVERY
+                or time.monotonic() - self.flushed_at >= FLUSH_INTERVAL):
+            self.flush()
+
+    def flush(self):
+        """
+        Push the recorded outcomes to Redis.
+        """
+        self.flushed_at = time.monotonic()
+        if not self.successes and not self.failures:
+            return
+
+        state = frappe.safe_decode(self.record_script(
+            keys=[self.key],
+            args=[self.successes, self.failures, self.window, self.failure_rate, self.min_requests,
+                  int(self.probe)]
+        ))
+        self.successes = self.failures = 0
+        self.probe = False
+
+        if state in ("opened", "reopened"):
+            metrics.incr("circuit_opened", circuit=self.name)
+        if state != "closed":
+            self.open_until = time.monotonic() + self.open_seconds
+
+    def _refuse(self, retry_after):
+        self.open_until = time.monotonic() + retry_after
+        raise CircuitOpen(self.name, retry_after)
+
+def get_circuit_breaker(name):
+    """
+    Return a CircuitBreaker for `name` configured from FCM Notification Settings.
+    """
+    settings = frappe.get_cached_doc("FCM Notification Settings")
+    if name == "oauth":
+        min_requests = cint(settings.circuit_oauth_min_requests) or DEFAULT_OAUTH_MIN_REQUESTS
+    else:
+        min_requests = cint(settings.circuit_min_requests) or DEFAULT_MIN_REQUESTS
+
+    return CircuitBreaker(
+        name,
+        failure_rate=flt(settings.circuit_failure_rate) or DEFAULT_FAILURE_RATE,
+        min_requests=min_requests,
+        window=cint(settings.circuit_window) or DEFAULT_WINDOW,
+        open_seconds=cint(settings.circuit_open_seconds) or DEFAULT_OPEN_SECONDS
+    )
+
+def is_endpoint_failure(result):
+    """
+    Whether a SendResult means the endpoint itself is failing.
+
+    Network errors and 5xx count; 4xx answers (dead tokens, quota) come
+    from a healthy endpoint.
+    """
+    return result.status_code is None or result.status_code >= 500
+
+def get_circuit_states():
+    """
+    Return the state of every circuit, for FCM Notification Settings.
+    """
+    settings = frappe.get_cached_doc("FCM Notification Settings")
+    open_seconds = cint(settings.circuit_open_seconds) or DEFAULT_OPEN_SECONDS
+    cache = frappe.cache()
+
+    states = []
+    for name in CIRCUITS:
+        values = {
+            frappe.safe_decode(key): flt(frappe.safe_decode(value))
+            for key, value in (cache.execute_command("HGETALL", CIRCUIT_KEY.format(name=name)) or {}).items()
+        }
+        opened_at = values.get("opened_at")
+        if not opened_at:
+            state = "Closed"
+        elif time.time() < opened_at + open_seconds:
+            state = "Open"
+        else:
+            state = "Half-open"
+        states.append({
+            "name": name,
+            "state": state,
+            "opened_at": opened_at,
+            "successes": cint(values.get("successes")),
+            "failures": cint(values.get("failures"))
+        })
+    return states
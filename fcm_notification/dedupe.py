@@ -0,0 +1,49 @@
+import hashlib
+
+import frappe
+from frappe.utils import cint, cstr
+
+from fcm_notification import metrics
+
+DEDUPE_KEY = "fcm_notification:dedupe:{}"
+# Default, overridable in FCM Notification Settings
+DEFAULT_DEDUPE_WINDOW = 10
+
+def get_idempotency_key(rule, reference_doctype, reference_name, recipient, subject, message):
+    """
+    Key identifying one push of one rule, for one document and one recipient.
+    """
+    content_hash = hashlib.sha1(f"{cstr(subject)}\0{cstr(message)}".encode()).hexdigest()
+    parts = (rule, reference_doctype, reference_name, recipient, content_hash)
+    return hashlib.sha1("\0".join(cstr(part) for part in parts).encode()).hexdigest()
+
+def claim_idempotency_keys(keys):
+    """
+    Claim `keys` for the dedupe window and return which ones are new.
+
+    A key already claimed within the window belongs to a push that was
+    created by another hook of the same user action (e.g. after_insert and
+    on_update of one insert). Claims are atomic (`SET NX`), so concurrent
+    workers cannot both win.
+
+    Returns:
+        list: one bool per key, False for duplicates
+    """
+    window = get_dedupe_window()
+    if not keys or not window:
+        return [True] * len(keys)
+
+    cache = frappe.cache()
+    pipeline = cache.pipeline()
+    for key in keys:
+        pipeline.set(cache.make_key(DEDUPE_KEY.format(key)), 1, nx=True, ex=window)
+    claimed = [bool(result) for result in pipeline.execute()]
+
+    metrics.incr("duplicates_dropped", claimed.count(False))
+    return claimed
+
+def get_dedupe_window():
+    settings = frappe.get_cached_doc("FCM Notification Settings")
+    if settings.dedupe_window is None:
+        return DEFAULT_DEDUPE_WINDOW
+    return cint(settings.dedupe_window)
@@ -0,0 +1,118 @@
+import hashlib
+import json
+import time
+
+import frappe
+
+from fcm_notification import metrics
+from fcm_notification.recipients import get_user_devices
+
+# Buffered pushes of one rule for one user
+DIGEST_ITEMS_KEY = "fcm_notification:digest:{}"
+# Sorted set of buffers, scored by the time they are due to be sent
+DIGEST_DUE_KEY = "fcm_notification:digest_due"
+# Buffers outlive their window by this much in case the scheduler is down
+DIGEST_TTL_MARGIN = 86400
+# A summary lists at most this many of the buffered subjects
+DIGEST_PREVIEW_LINES = 5
+
+def add_to_digest(rule, users, subject, message, window, reference_doc, priority=None):
+    """
+    Buffer a push for `users` instead of sending it now.
+
+    The first push for a (rule, user) pair starts the window; everything
+    buffered until it ends is sent as a single summary by `flush_due_digests`.
+    """
+    cache = frappe.cache()
+    due_key = cache.make_key(DIGEST_DUE_KEY)
+    due = time.time() + window
+    item = json.dumps({
+        "subject": subject,
+        "message": message,
+        "reference_doctype": reference_doc.doctype,
+        "reference_name": reference_doc.name,
+        "priority": priority
+    })
+
+    pipeline = cache.pipeline()
+    for user in users:
+        member = json.dumps([rule, user])
+        items_key = cache.make_key(DIGEST_ITEMS_KEY.format(member))
+        pipeline.rpush(items_key, item)
+        pipeline.expire(items_key, window + DIGEST_TTL_MARGIN)
+        pipeline.zadd(due_key, {member: due}, nx=True)
+    pipeline.execute()
+
+def flush_due_digests():
+    """
+    Scheduled job: send one summary push per buffer whose window has ended.
+    """
+    cache = frappe.cache()
+    due_key = cache.make_key(DIGEST_DUE_KEY)
+
+    for member in cache.zrangebyscore(due_key, 0, time.time()):
+        # Whoever removes the entry owns the flush
+        if not cache.zrem(due_key, member):
+            continue
+
+        items_key = cache.make_key(DIGEST_ITEMS_KEY.format(frappe.safe_decode(member)))
+        pipeline = cache.pipeline()
+        pipeline.lrange(items_key, 0, -1)
+        pipeline.delete(items_key)
+        items, _ = pipeline.execute()
+        if not items:
+            continue
+
+        rule, user = json.loads(member)
+        try:
+            send_digest(rule, user, [json.loads(item) for item in items])
+            frappe.db.commit()
+        except Exception:
+            frappe.db.rollback()
+            frappe.log_error(
+                f"Error sending FCM digest of {rule} for {user}",
+                "FCM Notification Error"
+            )
+
+def send_digest(rule, user, items):
+    """
+    Create a single FCM Notification summarizing `items` for `user`.
+    """
+    from fcm_notification.send_notification import create_fcm_notification
+
+    devices = get_user_devices([user])
+    if not devices:
+        return
+
+    count = len(items)
+    latest = items[-1]
+    subject, message = get_digest_content(items)
+
+    create_fcm_notification(
+        subject,
+        message,
+        reference_doc=frappe._dict(doctype=latest["reference_doctype"], name=latest["reference_name"]),
+        recipients=devices,
+        collapse_key=get_collapse_key(rule),
+        digest_count=count,
+        # The rule's priority, so a High priority digest keeps its lane
+        priority=latest.get("priority")
+    )
+    metrics.incr("digest_sends_saved", count - 1)
+
+def get_digest_content(items):
+    """
+    Return the `(subject, message)` summarizing `items` (oldest first).
+    """
+    if len(items) == 1:
+        return items[0]["subject"], items[0]["message"]
+
+    subject = f"{len(items)} new notifications"
+    message = "\n".join(item["subject"] for item in reversed(items[-DIGEST_PREVIEW_LINES:]))
+    return subject, message
+
+def get_collapse_key(rule):
+    """
+    Collapse key for the digests of a rule; devices only keep the latest one.
+    """
+    return "fcm-digest-" + hashlib.sha1(rule.encode()).hexdigest()[:16]
@@ -0,0 +1,258 @@
+import os
+import socket
+import time
+
+import frappe
+from frappe.utils import add_to_date, cint, now_datetime
+
+from fcm_notification.retry import get_max_attempts
+
+# Fresh rows belong to their enqueued job; the dispatcher only takes them
+# once they have waited this long (worker crash, lost job, rolled back enqueue)
+DISPATCH_GRACE_PERIOD = 60
+DISPATCH_BATCH_SIZE = 50
+# Drain jobs stop starting new rows after this long and hand back the rest
+DRAIN_TIME_BUDGET = 50
+# Default, overridable in FCM Notification Settings
+DEFAULT_DISPATCHER_JOBS = 1
+# claimed_by of rows the dispatcher handed to a delivery job on their own lane
+HANDOVER_CLAIM = "handover"
+
+def get_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def get_lease_expiry():
+    """
+    A claim outlives the delivery job that holds it by at most its timeout.
+    """
+    from fcm_notification.send_notification import DEFAULT_JOB_TIMEOUT
+
+    settings = frappe.get_cached_doc("FCM Notification Settings")
+    return add_to_date(now_datetime(), seconds=cint(settings.job_timeout) or DEFAULT_JOB_TIMEOUT)
+
+def claim_notification(notification, handover=False):
+    """
+    Claim a single FCM Notification for this worker.
+
+    With `handover`, take over a row the dispatcher claimed and handed to
+    this job's lane; that claim already counted the attempt.
+
+    Returns:
+        bool: False if the row is not pending or another worker holds it
+    """
+    now = now_datetime()
+    if handover:
+        condition = "status = 'CLAIMED' and claimed_by = %(handover)s"
+    else:
+        condition = """(status = 'NEW'
+                or (status = 'RETRY' and next_retry_at <= %(now)s)
+                or (status = 'CLAIMED' and lease_expires_at <= %(now)s))"""
+
+    row = frappe.db.sql(
+        f"""select name from `tabFCM Notification`
+        where name = %(name)s and {condition}
+        for update skip locked""",
+        {"name": notification, "now": now, "handover": HANDOVER_CLAIM}
+    )
+    if not row:
+        frappe.db.rollback()
+        return False
+
+    if handover:
+        frappe.db.set_value("FCM Notification", notification, {
+            "claimed_by": get_worker_id(),
+            "lease_expires_at": get_lease_expiry()
+        }, update_modified=False)
+    elif not _mark_claimed([notification]):
+        frappe.db.commit()
+        return False
+    frappe.db.commit()
+    return True
+
+def claim_batch(limit=DISPATCH_BATCH_SIZE, lease_expires_at=None):
+    """
+    Claim up to `limit` pending FCM Notifications for this worker.
+
+    Rows locked by a concurrent claim are skipped rather than waited for, so
+    any number of workers on any number of bench nodes can drain the outbox
+    in parallel without claiming (and sending) a row twice.
+
+    `lease_expires_at` defaults to the end of a full delivery job.
+
+    Returns:
+        list: names of the claimed rows, without those given up on
+    """
+    now = now_datetime()
+    grace = add_to_date(now, seconds=-DISPATCH_GRACE_PERIOD)
+
+    names = []
+    for condition, values in (
+        ("status = 'RETRY' and next_retry_at <= %(now)s", {"now": now}),
+        ("status = 'NEW' and creation <= %(grace)s", {"grace": grace}),
+        ("status = 'CLAIMED' and lease_expires_at <= %(now)s", {"now": now}),
+    ):
+        if len(names) >= limit:
+            break
+        names += frappe.db.sql(
+            f"""select name from `tabFCM Notification`
+            where {condition}
+            order by creation asc
+            limit {cint(limit - len(names))}
+            for update skip locked""",
+            values,
+            pluck=True
+        )
+
+    if names:
+        names = _mark_claimed(names, lease_expires_at)
+    frappe.db.commit()
+    return names
+
+def _mark_claimed(names, lease_expires_at=None):
+    """
+    Claim the rows `names`, locked by the caller; return the claimed ones.
+    """
+    settings = frappe.get_cached_doc("FCM Notification Settings")
+    FCMNotification = frappe.qb.DocType("FCM Notification")
+
+    # A row whose delivery keeps crashing is given up after the last attempt
+    exhausted = set(frappe.get_all(
+        "FCM Notification",
+        filters={"name": ["in", names], "attempts": [">=", get_max_attempts(settings)]},
+        pluck="name"
+    ))
+    if exhausted:
+        (
+            frappe.qb.update(FCMNotification)
+            .set(FCMNotification.status, "FAILED")
+            .set(FCMNotification.claimed_by, None)
+            .set(FCMNotification.lease_expires_at, None)
+            .where(FCMNotification.name.isin(list(exhausted)))
+        ).run()
+
+    names = [name for name in names if name not in exhausted]
+    if names:
+        (
+            frappe.qb.update(FCMNotification)
+            .set(FCMNotification.status, "CLAIMED")
+            .set(FCMNotification.claimed_by, get_worker_id())
+            .set(FCMNotification.lease_expires_at, lease_expires_at or get_lease_expiry())
+            .set(FCMNotification.attempts, FCMNotification.attempts + 1)
+            .where(FCMNotification.name.isin(names))
+        ).run()
+    return names
+
+def release_claims(names):
+    """
+    Hand back rows this worker claimed but did not start sending.
+
+    They are due again right away and the claim does not count as an attempt.
+    """
+    if not names:
+        return
+
+    FCMNotification = frappe.qb.DocType("FCM Notification")
+    (
+        frappe.qb.update(FCMNotification)
+        .set(FCMNotification.status, "RETRY")
+        .set(FCMNotification.next_retry_at, now_datetime())
+        .set(FCMNotification.claimed_by, None)
+        .set(FCMNotification.lease_expires_at, None)
+        .set(FCMNotification.attempts, FCMNotification.attempts - 1)
+        .where(FCMNotification.name.isin(names))
+        .where(FCMNotification.status == "CLAIMED")
+        .where(FCMNotification.claimed_by == get_worker_id())
+    ).run()
+    frappe.db.commit()
+
+def dispatch():
+    """
+    Scheduled job: start the configured number of outbox drain jobs.
+    """
+    from fcm_notification.send_notification import DEFAULT_JOB_TIMEOUT
+
+    settings = frappe.get_cached_doc("FCM Notification Settings")
+    for i in range(cint(settings.dispatcher_jobs) or DEFAULT_DISPATCHER_JOBS):
+        # Not enqueued again while the previous run of this slot is queued or running
+        frappe.enqueue(
+            "fcm_notification.dispatcher.drain_outbox",
+            queue=get_drain_queue(settings),
+            timeout=cint(settings.job_timeout) or DEFAULT_JOB_TIMEOUT,
+            job_id=f"fcm_notification:drain_outbox:{i}",
+            deduplicate=True
+        )
+
+def drain_outbox():
+    """
+    Background job: claim and send pending FCM Notifications batch by batch.
+
+    Picks up rows that were never sent (lost jobs, crashed workers), retries
+    that are due and claims whose lease expired. Rows of the dispatcher's
+    own lane are sent here; broadcasts and high priority rows are handed to
+    a delivery job on their lane, so they keep their place in the lanes.
+    """
+    from fcm_notification.send_notification import get_delivery_queue, send_fcm_message
+
+    settings = frappe.get_cached_doc("FCM Notification Settings")
+    own_queue = get_drain_queue(settings)
+    deadline = time.monotonic() + DRAIN_TIME_BUDGET
+    while time.monotonic() < deadline:
+        # Rows of a killed drain come back soon; each row gets a full lease once it is started
+        names = claim_batch(lease_expires_at=add_to_date(now_datetime(), seconds=DRAIN_TIME_BUDGET + DISPATCH_GRACE_PERIOD))
+        if not names:
+            break
+
+        for i, notification in enumerate(names):
+            # One slow row (e.g. a large broadcast) must not hold the rest of the batch
+            if time.monotonic() >= deadline:
+                release_claims(names[i:])
+                return
+
+            try:
+                doc = frappe.get_doc("FCM Notification", notification)
+                queue = get_delivery_queue(doc, settings)
+                if queue != own_queue:
+                    hand_over(notification, queue, settings)
+                    continue
+
+                frappe.db.set_value(
+                    "FCM Notification", notification, "lease_expires_at", get_lease_expiry(), update_modified=False
+                )
+                frappe.db.commit()
+                send_fcm_message(doc)
+            except Exception:
+                # The claim expires and the row is picked up again
+                frappe.db.rollback()
+                frappe.log_error(
+                    f"Error sending FCM notification {notification}",
+                    "FCM Notification"
+                )
+
+def hand_over(notification, queue, settings):
+    """
+    Pass a claimed row to a delivery job on `queue`, keeping the claim.
+
+    If the job is lost, the lease expires and the row is claimed again.
+    """
+    from fcm_notification.send_notification import DEFAULT_JOB_TIMEOUT
+
+    frappe.db.set_value("FCM Notification", notification, {
+        "claimed_by": HANDOVER_CLAIM,
+        "lease_expires_at": get_lease_expiry()
+    }, update_modified=False)
+    frappe.db.commit()
+
+    frappe.enqueue(
+        "fcm_notification.send_notification.deliver_fcm_notification",
+        queue=queue,
+        timeout=cint(settings.job_timeout) or DEFAULT_JOB_TIMEOUT,
+        job_id=f"fcm_notification:handover:{notification}",
+        deduplicate=True,
+        notification=notification,
+        handover=True
+    )
+
+def get_drain_queue(settings):
+    from fcm_notification.send_notification import DEFAULT_QUEUE
+
+    return settings.queue_name or DEFAULT_QUEUE
@@ -1,8 +1,14 @@
 # Copyright (c) 2025, Raheeb and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
 
 class FCMNotification(Document):
 	pass
+
+def on_doctype_update():
+	# Pending work is found by status in creation order, retries by due time
+	frappe.db.add_index("FCM Notification", ["status", "creation"])
+	frappe.db.add_index("FCM Notification", ["status", "next_retry_at"])
+	frappe.db.add_index("FCM Notification", ["reference_doctype", "reference_name"])
@@ -1,9 +1,305 @@
 # Copyright (c) 2025, Raheeb and Contributors
 # See license.txt
 
-# import frappe
+import json
+import time
+from email.utils import formatdate
+from unittest.mock import patch
+
+import frappe
 from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_to_date, get_datetime, now_datetime
+
+from fcm_notification import send_notification
+from fcm_notification.circuit_breaker import CircuitOpen
+from fcm_notification.dispatcher import HANDOVER_CLAIM, claim_batch, claim_notification, get_worker_id
+from fcm_notification.retry import get_max_attempts, get_retry_after, get_retry_delay
+from fcm_notification.rules import CompiledRule, compile_condition
+from fcm_notification.send_notification import ChunkTracker
+from fcm_notification.sender import (
+	OUTCOME_DEAD_TOKEN,
+	OUTCOME_FAILED,
+	OUTCOME_SENT,
+	OUTCOME_TRANSIENT,
+	SendResult,
+	classify_result,
+	get_error
+)
+
+# Conditions that try to escape the rule sandbox
+UNSAFE_CONDITIONS = (
+	'"{0.__init__.__globals__}".format(doc)',
+	'"{0.__init__.__globals__[SECRET]}".format(doc)[0] == "h"',
+	'"{x.__class__}".format_map({"x": doc})',
+	'str.format("{0.__init__}", doc)',
+	'doc.__class__',
+	'f"{doc.__init__.__globals__}"',
+	'[g.gi_frame for g in [(x for x in [1])]]',
+	'(found := doc.name)',
+	'__import__("os")',
+)
 
 
 class TestFCMNotification(FrappeTestCase):
-	pass
+	def test_unsafe_conditions_are_rejected(self):
+		for condition in UNSAFE_CONDITIONS:
+			with self.subTest(condition=condition):
+				self.assertRaises(frappe.ValidationError, compile_condition, condition, "Test Rule")
+
+	def test_safe_condition(self):
+		rule = CompiledRule(frappe._dict(
+			name="Test Rule",
+			condition='doc.status == "Open" and flt(doc.amount) > 10 and len(cstr(doc.title)) > 3',
+			subject="{{ doc.title }}",
+			message="{{ doc.status }}"
+		))
+
+		self.assertTrue(rule.matches(frappe._dict(title="Test title", status="Open", amount=20)))
+		self.assertFalse(rule.matches(frappe._dict(title="Test title", status="Closed", amount=20)))
+		self.assertEqual(rule.render(frappe._dict(title="Test title", status="Open")), ("Test title", "Open"))
+
+
+def fcm_error(status, message="", error_code=None):
+	error = {"code": 0, "status": status, "message": message}
+	if error_code:
+		error["details"] = [{"@type": "type.googleapis.com/google.firebase.fcm.v1.FcmError", "errorCode": error_code}]
+	return json.dumps({"error": error})
+
+
+class TestSendResults(FrappeTestCase):
+	def test_classify_result(self):
+		cases = (
+			(200, "{}", OUTCOME_SENT),
+			(404, fcm_error("NOT_FOUND", "Requested entity was not found.", "UNREGISTERED"), OUTCOME_DEAD_TOKEN),
+			(400, fcm_error("INVALID_ARGUMENT", "The registration token is not a valid FCM registration token"),
+				OUTCOME_DEAD_TOKEN),
+			(403, fcm_error("PERMISSION_DENIED", "SenderId mismatch", "SENDER_ID_MISMATCH"), OUTCOME_DEAD_TOKEN),
+			# A 404 without an FCM error code (wrong project, proxy) says nothing about the token
+			(404, fcm_error("NOT_FOUND", "Requested entity was not found."), OUTCOME_FAILED),
+			(404, "<html>Not Found</html>", OUTCOME_FAILED),
+			(400, fcm_error("INVALID_ARGUMENT", "Invalid JSON payload received."), OUTCOME_FAILED),
+			(429, fcm_error("RESOURCE_EXHAUSTED", "Quota exceeded", "QUOTA_EXCEEDED"), OUTCOME_TRANSIENT),
+			(503, fcm_error("UNAVAILABLE", "The service is currently unavailable."), OUTCOME_TRANSIENT),
+			(None, "Connection reset by peer", OUTCOME_TRANSIENT),
+		)
+		for status_code, text, outcome in cases:
+			with self.subTest(status_code=status_code, text=text):
+				self.assertEqual(classify_result(SendResult("token", status_code, text, {}, None)), outcome)
+
+	def test_get_error(self):
+		result = SendResult("token", 404, fcm_error("NOT_FOUND", "Not found", "UNREGISTERED"), {}, None)
+		self.assertEqual(get_error(result), ("UNREGISTERED", "Not found"))
+
+		result = SendResult("token", 502, "Bad Gateway", {}, None)
+		self.assertEqual(get_error(result), (None, "Bad Gateway"))
+
+	def test_retry_after(self):
+		def retry_after(value):
+			return get_retry_after(SendResult("token", 429, "", {"Retry-After": value} if value else {}, None))
+
+		self.assertEqual(retry_after("120"), 120)
+		self.assertAlmostEqual(retry_after(formatdate(time.time() + 120, usegmt=True)), 120, delta=2)
+		# A date in the past means now
+		self.assertEqual(retry_after(formatdate(time.time() - 120, usegmt=True)), 0)
+		self.assertEqual(retry_after("soon"), 0)
+		self.assertEqual(retry_after(None), 0)
+
+	def test_retry_delay(self):
+		settings = frappe._dict(retry_base_delay=10, retry_max_delay=60)
+		for attempt in range(1, 10):
+			with self.subTest(attempt=attempt):
+				self.assertLessEqual(get_retry_delay(attempt, settings=settings), min(60, 10 * 2 ** (attempt - 1)))
+				# Never sooner than FCM asked for
+				self.assertGreaterEqual(get_retry_delay(attempt, 300, settings), 300)
+
+
+class TestChunkTracker(FrappeTestCase):
+	def test_out_of_order_completion(self):
+		tracker = ChunkTracker([("a", ["t1", "t2"]), ("b", ["t3"]), ("c", ["t4"])])
+		self.assertEqual(list(tracker.tokens()), ["t1", "t2", "t3", "t4"])
+
+		# Later chunks finishing first do not move the cursor past an open chunk
+		self.assertIsNone(tracker.complete("t3"))
+		self.assertIsNone(tracker.complete("t2"))
+		self.assertIsNone(tracker.last_cursor)
+
+		self.assertEqual(tracker.complete("t1"), "b")
+		self.assertEqual(tracker.last_cursor, "b")
+		self.assertEqual(tracker.complete("t4"), "c")
+		self.assertFalse(tracker.stopped)
+
+	def test_stop_between_chunks(self):
+		calls = []
+
+		def should_stop():
+			calls.append(len(calls))
+			return True
+
+		tracker = ChunkTracker([("a", ["t1", "t2"]), ("b", ["t3"])], should_stop)
+		self.assertEqual(list(tracker.tokens()), ["t1", "t2"])
+		self.assertTrue(tracker.stopped)
+		# Only asked at chunk boundaries, never before the first chunk
+		self.assertEqual(len(calls), 1)
+
+		tracker.complete("t2")
+		self.assertEqual(tracker.complete("t1"), "a")
+
+
+def make_notification(**values):
+	# Never inserted as NEW, so no delivery job is queued
+	return frappe.get_doc({
+		"doctype": "FCM Notification",
+		"subject": "FCM test",
+		"message": "Test message",
+		**values
+	}).insert(ignore_permissions=True).name
+
+
+class TestDispatcher(FrappeTestCase):
+	def tearDown(self):
+		frappe.db.rollback()
+		frappe.db.delete("FCM Notification", {"subject": "FCM test"})
+		frappe.db.commit()
+
+	def test_claim_batch(self):
+		past = add_to_date(now_datetime(), minutes=-1)
+		settings = frappe.get_cached_doc("FCM Notification Settings")
+
+		due = make_notification(status="RETRY", next_retry_at=past, attempts=1)
+		not_due = make_notification(status="RETRY", next_retry_at=add_to_date(now_datetime(), minutes=10), attempts=1)
+		claimed = make_notification(
+			status="CLAIMED", claimed_by="other:1", lease_expires_at=add_to_date(now_datetime(), minutes=10), attempts=1
+		)
+		expired = make_notification(status="CLAIMED", claimed_by="other:1", lease_expires_at=past, attempts=1)
+		exhausted = make_notification(status="RETRY", next_retry_at=past, attempts=get_max_attempts(settings))
+		frappe.db.commit()
+
+		names = claim_batch(limit=1000)
+
+		self.assertIn(due, names)
+		self.assertIn(expired, names)
+		self.assertNotIn(not_due, names)
+		self.assertNotIn(claimed, names)
+		self.assertNotIn(exhausted, names)
+
+		for name in (due, expired):
+			row = frappe.db.get_value("FCM Notification", name, ["status", "claimed_by", "attempts"], as_dict=True)
+			self.assertEqual((row.status, row.claimed_by, row.attempts), ("CLAIMED", get_worker_id(), 2))
+		self.assertEqual(frappe.db.get_value("FCM Notification", claimed, "claimed_by"), "other:1")
+		self.assertEqual(frappe.db.get_value("FCM Notification", exhausted, "status"), "FAILED")
+
+		# Claimed rows are not claimed again
+		self.assertFalse({due, expired} & set(claim_batch(limit=1000)))
+
+	def test_claim_exhausted_notification(self):
+		settings = frappe.get_cached_doc("FCM Notification Settings")
+		name = make_notification(
+			status="RETRY", next_retry_at=add_to_date(now_datetime(), minutes=-1), attempts=get_max_attempts(settings)
+		)
+		frappe.db.commit()
+
+		self.assertFalse(claim_notification(name))
+		self.assertEqual(frappe.db.get_value("FCM Notification", name, "status"), "FAILED")
+
+	def test_handover(self):
+		name = make_notification(
+			status="CLAIMED",
+			claimed_by=HANDOVER_CLAIM,
+			lease_expires_at=add_to_date(now_datetime(), minutes=10),
+			attempts=1
+		)
+		frappe.db.commit()
+
+		# Only a handover job takes over the row, without counting another attempt
+		self.assertFalse(claim_notification(name))
+		self.assertTrue(claim_notification(name, handover=True))
+		row = frappe.db.get_value("FCM Notification", name, ["status", "claimed_by", "attempts"], as_dict=True)
+		self.assertEqual((row.status, row.claimed_by, row.attempts), ("CLAIMED", get_worker_id(), 1))
+
+		self.assertFalse(claim_notification(name, handover=True))
+
+
+class FakeTransport:
+	def post(self, url, headers, body):
+		return frappe._dict(status_code=200, text="{}", headers={})
+
+
+class FakeBreaker:
+	def __init__(self, open_after=None):
+		self.open_after = open_after
+		self.checks = 0
+
+	def allow(self):
+		pass
+
+	def check(self):
+		self.checks += 1
+		if self.open_after is not None and self.checks > self.open_after:
+			raise CircuitOpen("fcm", 30)
+
+	def record(self, success):
+		pass
+
+	def flush(self):
+		pass
+
+
+class FakeLimiter:
+	waits = 0
+	waited = 0
+
+	def acquire(self):
+		return 0
+
+
+class TestBroadcastDelivery(FrappeTestCase):
+	def tearDown(self):
+		frappe.db.rollback()
+		frappe.db.delete("FCM Notification", {"subject": "FCM test"})
+		frappe.db.commit()
+
+	def send_broadcast(self, breaker, high_priority_pending=False):
+		read = []
+
+		def iter_chunks(cursor=None):
+			for chunk in (("c1", ["t1", "t2"]), ("c2", ["t3", "t4"]), ("c3", ["t5", "t6"])):
+				read.append(chunk[0])
+				yield chunk
+
+		name = make_notification(status="CLAIMED", all_users=1, attempts=1)
+		with patch.object(send_notification, "get_circuit_breaker", return_value=breaker), \
+				patch.object(send_notification, "get_access_token", return_value={"token": "x", "project_id": "test"}), \
+				patch.object(send_notification, "get_transport", return_value=FakeTransport()), \
+				patch.object(send_notification, "get_rate_limiter", return_value=FakeLimiter()), \
+				patch.object(send_notification, "iter_broadcast_chunks", iter_chunks), \
+				patch.object(send_notification, "has_pending_high_priority_notifications", return_value=high_priority_pending), \
+				patch("frappe.enqueue") as enqueue:
+			send_notification.send_fcm_message(frappe.get_doc("FCM Notification", name))
+
+		return frappe.get_doc("FCM Notification", name), read, enqueue
+
+	def test_complete_broadcast(self):
+		doc, read, enqueue = self.send_broadcast(FakeBreaker())
+
+		self.assertEqual(read, ["c1", "c2", "c3"])
+		self.assertEqual((doc.status, doc.sent_count, doc.attempts), ("SENT", 6, 1))
+		self.assertFalse(doc.broadcast_cursor)
+		enqueue.assert_not_called()
+
+	def test_yield_to_high_priority(self):
+		doc, read, enqueue = self.send_broadcast(FakeBreaker(), high_priority_pending=True)
+
+		self.assertEqual(read, ["c1"])
+		# Yielding is not an attempt; the broadcast is queued again after the cursor
+		self.assertEqual((doc.status, doc.broadcast_cursor, doc.sent_count, doc.attempts), ("NEW", "c1", 2, 0))
+		enqueue.assert_called_once()
+
+	def test_stop_when_circuit_opens(self):
+		doc, read, enqueue = self.send_broadcast(FakeBreaker(open_after=2))
+
+		# The page being sent is refused and kept; no further pages are read
+		self.assertEqual(read, ["c1", "c2"])
+		self.assertEqual((doc.status, doc.broadcast_cursor, doc.sent_count, doc.attempts), ("RETRY", "c2", 2, 0))
+		self.assertEqual(json.loads(doc.pending_tokens), ["t3", "t4"])
+		self.assertGreater(get_datetime(doc.next_retry_at), now_datetime())
+		enqueue.assert_not_called()
@@ -0,0 +1,12 @@
+# Copyright (c) 2026, Raheeb and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+class FCMNotificationDailyCount(Document):
+	pass
+
+def on_doctype_update():
+	# The retention job looks up the row of a day and reference before adding to it
+	frappe.db.add_index("FCM Notification Daily Count", ["date", "reference_doctype", "reference_name"])
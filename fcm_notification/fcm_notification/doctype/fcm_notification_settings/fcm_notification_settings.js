@@ -1,8 +1,29 @@
 // Copyright (c) 2022, Raheeb and contributors
 // For license information, please see license.txt
 
+const CIRCUIT_LABELS = {
+	fcm: __('FCM'),
+	oauth: __('OAuth token endpoint')
+};
+
 frappe.ui.form.on('FCM Notification Settings', {
-	// refresh: function(frm) {
+	refresh: function(frm) {
+		// Show when delivery is paused by an open circuit breaker
+		const circuits = ((frm.doc.__onload || {}).circuit_breakers || []).filter(
+			(circuit) => circuit.state !== 'Closed'
+		);
+		if (!circuits.length) {
+			frm.set_intro('');
+			return;
+		}
 
-	// }
+		const lines = circuits.map((circuit) => __('{0} circuit is {1} since {2} ({3} of {4} requests failed). Delivery is paused; pending notifications are sent once a probe succeeds.', [
+			CIRCUIT_LABELS[circuit.name] || circuit.name,
+			circuit.state.toLowerCase(),
+			frappe.datetime.comment_when(moment.unix(circuit.opened_at).format()),
+			circuit.failures,
+			circuit.successes + circuit.failures
+		]));
+		frm.set_intro(lines.join('<br>'), 'red');
+	}
 });
@@ -4,5 +4,21 @@
 # import frappe
 from frappe.model.document import Document
 
+from fcm_notification.circuit_breaker import get_circuit_states
+from fcm_notification.oauth import clear_access_token_cache
+from fcm_notification.topics import enqueue_topic_reconcile
+
+# Fields deciding which topics devices must be subscribed to
+TOPIC_FIELDS = ("use_topic_broadcast", "broadcast_topic", "subscribe_role_topics")
+
 class FCMNotificationSettings(Document):
-	pass
+	def onload(self):
+		self.set_onload("circuit_breakers", get_circuit_states())
+
+	def on_update(self):
+		# The service account may have changed; cached tokens belong to the old one
+		clear_access_token_cache()
+
+		# Broadcasts go to the new topics right away; subscribe existing devices now
+		if self.use_topic_broadcast and any(self.has_value_changed(fieldname) for fieldname in TOPIC_FIELDS):
+			enqueue_topic_reconcile()
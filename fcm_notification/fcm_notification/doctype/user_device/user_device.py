@@ -1,8 +1,31 @@
 # Copyright (c) 2022, Raheeb and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
+from frappe.utils import now
 from frappe.model.document import Document
 
 class UserDevice(Document):
-	pass
+	def on_trash(self):
+		if self.topics:
+			frappe.enqueue(
+				"fcm_notification.topics.unsubscribe_device",
+				queue="short",
+				enqueue_after_commit=True,
+				token=self.device_token,
+				topics=self.topics
+			)
+
+def disable_device_tokens(tokens):
+	"""Mark the devices owning `tokens` as disabled, in one query per chunk."""
+	if not tokens:
+		return
+
+	UserDevice = frappe.qb.DocType("User Device")
+	for start in range(0, len(tokens), 500):
+		(
+			frappe.qb.update(UserDevice)
+			.set(UserDevice.disabled, 1)
+			.set(UserDevice.modified, now())
+			.where(UserDevice.device_token.isin(tokens[start:start + 500]))
+		).run()
@@ -57,7 +57,11 @@ app_license = "MIT"
 # ------------
 
 # before_install = "fcm_notification.install.before_install"
-# after_install = "fcm_notification.install.after_install"
+after_install = "fcm_notification.install.after_install"
+after_migrate = [
+    "fcm_notification.install.after_migrate",
+    "fcm_notification.bulk.flush_touched_documents"
+]
 
 # Uninstallation
 # ------------
@@ -105,10 +109,15 @@ app_license = "MIT"
 
 doc_events = {
     "FCM Notification": {
-        "after_insert": "fcm_notification.send_notification.send_fcm_message"
+        "after_insert": "fcm_notification.send_notification.enqueue_fcm_message"
+    },
+    "HD Team": {
+        "on_update": "fcm_notification.recipients.clear_hd_team_cache",
+        "on_trash": "fcm_notification.recipients.clear_hd_team_cache"
     },
     "Notification": {
-        "before_validate": "fcm_notification.send_notification.notification_handler"
+        "before_validate": "fcm_notification.send_notification.notification_handler",
+        "on_trash": "fcm_notification.rules.on_notification_trash"
     },
     "*": {
         #"before_insert": "fcm_notification.send_notification.process_document_for_fcm",
@@ -134,6 +143,21 @@ doc_events = {
 # Scheduled Tasks
 # ---------------
 
+scheduler_events = {
+    "cron": {
+        "* * * * *": [
+            "fcm_notification.dispatcher.dispatch",
+            "fcm_notification.digest.flush_due_digests"
+        ]
+    },
+    "daily": [
+        "fcm_notification.topics.reconcile_topic_subscriptions"
+    ],
+    "daily_long": [
+        "fcm_notification.retention.purge_old_notifications"
+    ]
+}
+
 # scheduler_events = {
 # 	"all": [
 # 		"fcm_notification.tasks.all"
@@ -152,6 +176,21 @@ doc_events = {
 # 	]
 # }
 
+# Request Events
+# ----------------
+# Push buffered metrics to Redis
+after_request = [
+    "fcm_notification.bulk.flush_touched_documents",
+    "fcm_notification.metrics.flush"
+]
+
+# Job Events
+# ----------
+after_job = [
+    "fcm_notification.bulk.flush_touched_documents",
+    "fcm_notification.metrics.flush"
+]
+
 # Testing
 # -------
 
@@ -0,0 +1,52 @@
+from frappe.custom.doctype.custom_field.custom_field import create_custom_fields
+
+def after_install():
+    create_fcm_custom_fields()
+
+def after_migrate():
+    create_fcm_custom_fields()
+
+def create_fcm_custom_fields():
+    """
+    Add the per-rule FCM options to Notification.
+    """
+    create_custom_fields(get_custom_fields(), update=True)
+
+def get_custom_fields():
+    return {
+        "Notification": [
+            {
+                "fieldname": "fcm_section",
+                "fieldtype": "Section Break",
+                "label": "FCM",
+                "insert_after": "message",
+                "depends_on": "eval:doc.channel=='FCM'",
+                "collapsible": 1
+            },
+            {
+                "fieldname": "fcm_digest_window",
+                "fieldtype": "Int",
+                "label": "Digest Window",
+                "insert_after": "fcm_section",
+                "description": "In seconds. When set, pushes for the same user within this window are combined into a single summary push. 0 sends every push immediately."
+            },
+            {
+                "fieldname": "fcm_priority",
+                "fieldtype": "Select",
+                "label": "Priority",
+                "options": "Normal\nHigh\nLow",
+                "default": "Normal",
+                "insert_after": "fcm_digest_window",
+                "description": "High priority pushes are delivered on their own queue, ahead of broadcasts."
+            },
+            {
+                "fieldname": "fcm_bulk_action",
+                "fieldtype": "Select",
+                "label": "During Bulk Operations",
+                "options": "Digest\nSend\nSuppress",
+                "default": "Digest",
+                "insert_after": "fcm_priority",
+                "description": "For documents written by Data Import, patches, migrations and other bulk operations. Digest sends one summary per recipient (after the Digest Window, or 5 minutes), Send pushes every document, Suppress sends nothing."
+            }
+        ]
+    }
@@ -0,0 +1,189 @@
+import json
+import threading
+import time
+from collections import defaultdict
+
+import frappe
+from frappe.utils import flt
+from werkzeug.wrappers import Response
+
+# All series of a site live in one Redis hash, shared by every worker and bench node
+METRICS_KEY = "fcm_notification:metrics"
+# Local buffers are pushed to Redis at most this often (and after every request and job)
+FLUSH_INTERVAL = 5
+# Histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# name: (type, help). Exported as fcm_<name>, counters with a _total suffix.
+METRICS = {
+    "rules_evaluated": ("counter", "FCM rules whose condition was evaluated for a document event."),
+    "rules_matched": ("counter", "FCM rules whose condition matched a document event."),
+    "bulk_documents_deferred": ("counter", "Documents whose FCM rules were deferred to the end of a bulk operation."),
+    "notifications_created": ("counter", "FCM Notification records created."),
+    "duplicates_dropped": ("counter", "Pushes dropped as duplicates of another hook of the same action."),
+    "digest_sends_saved": ("counter", "Pushes folded into a digest instead of being sent on their own."),
+    "sends": ("counter", "FCM sends by outcome and HTTP status code."),
+    "sends_deferred": ("counter", "Sends refused locally and left for a retry, by reason."),
+    "send_latency_seconds": ("histogram", "Latency of FCM send requests."),
+    "tokens_pruned": ("counter", "Dead device tokens disabled."),
+    "retries_scheduled": ("counter", "FCM Notifications rescheduled after a transient failure."),
+    "circuit_opened": ("counter", "Times a circuit breaker opened, by circuit."),
+    "token_cache_requests": ("counter", "Access token cache lookups by result."),
+    "token_refresh_seconds": ("histogram", "Time taken to fetch a new access token from Google."),
+    "rate_limiter_waits": ("counter", "Sends that had to wait for the rate limiter."),
+    "rate_limiter_wait_seconds": ("counter", "Time spent waiting for the rate limiter."),
+    "notifications_purged": ("counter", "FCM Notifications removed by the retention job, by status."),
+    "outbox_rows": ("gauge", "FCM Notification rows waiting to be delivered, by status."),
+    "job_queue_length": ("gauge", "Jobs waiting in the FCM delivery queues."),
+}
+
+_lock = threading.Lock()
+# site -> {series: value}, not yet pushed to Redis
+_buffers = {}
+_last_flush = {}
+
+def incr(name, amount=1, **labels):
+    """
+    Add `amount` to the counter `name`.
+    """
+    if amount:
+        _add([(_series(name, labels), amount)])
+
+def observe(name, value, **labels):
+    """
+    Record `value` (in seconds) in the histogram `name`.
+    """
+    items = [
+        (_series(f"{name}_bucket", {**labels, "le": bound}), 1)
+        for bound in LATENCY_BUCKETS if value <= bound
+    ]
+    items += [
+        (_series(f"{name}_bucket", {**labels, "le": "+Inf"}), 1),
+        (_series(f"{name}_sum", labels), value),
+        (_series(f"{name}_count", labels), 1),
+    ]
+    _add(items)
+
+def get(name, **labels):
+    """
+    Return the current cluster-wide value of the counter `name`.
+    """
+    flush()
+    cache = frappe.cache()
+    return flt(cache.execute_command("HGET", cache.make_key(METRICS_KEY), _series(name, labels)))
+
+def flush():
+    """
+    Push this process' buffered metrics to Redis.
+    """
+    site = getattr(frappe.local, "site", None)
+    if not site:
+        return
+
+    with _lock:
+        buffer = _buffers.pop(site, None)
+        _last_flush[site] = time.monotonic()
+    if not buffer:
+        return
+
+    cache = frappe.cache()
+    key = cache.make_key(METRICS_KEY)
+    pipeline = cache.pipeline()
+    for series, value in buffer.items():
+        pipeline.hincrbyfloat(key, series, value)
+    try:
+        pipeline.execute()
+    except Exception:
+        # Metrics must never break delivery; this batch is lost
+        pass
+
+@frappe.whitelist()
+def prometheus():
+    """
+    Return all FCM metrics in the Prometheus text exposition format.
+    """
+    frappe.only_for("System Manager")
+    flush()
+
+    cache = frappe.cache()
+    samples = defaultdict(list)
+    for series, value in (cache.execute_command("HGETALL", cache.make_key(METRICS_KEY)) or {}).items():
+        name, _, labels = frappe.safe_decode(series).partition("|")
+        samples[name].append((json.loads(labels or "{}"), flt(value)))
+
+    for status, count in get_outbox_depth().items():
+        samples["outbox_rows"].append(({"status": status}, count))
+    for queue, length in get_job_queue_lengths().items():
+        samples["job_queue_length"].append(({"queue": queue}, length))
+
+    lines = []
+    for name, (metric_type, description) in METRICS.items():
+        exported = f"fcm_{name}"
+        lines.append(f"# HELP {exported} {description}")
+        lines.append(f"# TYPE {exported} {metric_type}")
+        if metric_type == "counter":
+            lines += _render(f"{exported}_total", samples.get(name))
+        elif metric_type == "histogram":
+            for suffix in ("_bucket", "_sum", "_count"):
+                lines += _render(f"{exported}{suffix}", samples.get(f"{name}{suffix}"))
+        else:
+            lines += _render(exported, samples.get(name))
+
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+def get_outbox_depth():
+    rows = frappe.get_all(
+        "FCM Notification",
+        filters={"status": ["in", ["NEW", "CLAIMED", "RETRY"]]},
+        fields=["status", "count(name) as count"],
+        group_by="status"
+    )
+    depth = dict.fromkeys(("NEW", "CLAIMED", "RETRY"), 0)
+    depth.update({row.status: row.count for row in rows})
+    return depth
+
+def get_job_queue_lengths():
+    from frappe.utils.background_jobs import get_queue
+
+    settings = frappe.get_cached_doc("FCM Notification Settings")
+    queues = {settings.queue_name, settings.high_priority_queue, settings.broadcast_queue}
+    lengths = {}
+    for queue in filter(None, queues):
+        try:
+            lengths[queue] = get_queue(queue).count
+        except Exception:
+            continue
+    return lengths
+
+def _series(name, labels):
+    return f"{name}|{json.dumps(labels, sort_keys=True)}" if labels else name
+
+def _add(items):
+    site = frappe.local.site
+    with _lock:
+        buffer = _buffers.setdefault(site, defaultdict(float))
+        for series, value in items:
+            buffer[series] += value
+        due = time.monotonic() - _last_flush.get(site, 0) > FLUSH_INTERVAL
+
+    if due:
+        flush()
+
+def _render(name, samples):
+    for labels, value in sorted(samples or [], key=lambda sample: _sort_key(sample[0])):
+        if labels:
+            label_text = ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+            yield f"{name}{{{label_text}}} {_format(value)}"
+        else:
+            yield f"{name} {_format(value)}"
+
+def _sort_key(labels):
+    # Buckets in ascending order, +Inf last
+    return [(key, value if isinstance(value, (int, float)) else float("inf") if value == "+Inf" else 0, str(value))
+            for key, value in sorted(labels.items())]
+
+def _format(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
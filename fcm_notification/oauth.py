@@ -0,0 +1,162 @@
+import calendar
+import hashlib
+import json
+import time
+
+import frappe
+from frappe.utils import flt
+from google.auth.exceptions import TransportError
+from google.oauth2 import service_account
+from google.auth.transport.requests import Request
+from redis.exceptions import LockError
+
+from fcm_notification import metrics
+from fcm_notification.circuit_breaker import get_circuit_breaker
+from fcm_notification.transport import DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT
+
+FCM_SCOPE = "https://www.googleapis.com/auth/firebase.messaging"
+TOKEN_CACHE_PREFIX = "fcm_notification:access_token:"
+
+# Refresh tokens this many seconds before Google expires them
+REFRESH_MARGIN = 300
+# Only one worker refreshes at a time; the others wait for its result
+REFRESH_LOCK_TIMEOUT = 30
+REFRESH_LOCK_WAIT = 15
+
+def get_service_account_info():
+    """
+    Return the parsed service account JSON from FCM Notification Settings.
+    """
+    service_account_json = frappe.get_cached_doc("FCM Notification Settings").server_key
+    if not service_account_json:
+        frappe.throw("The service account JSON content is not configured in FCM Notification Settings.")
+
+    try:
+        return json.loads(service_account_json)
+    except ValueError as e:
+        frappe.throw(f"Error loading service account credentials: {e}")
+
+def get_access_token():
+    """
+    Return the OAuth 2.0 access token for the configured service account.
+
+    The token is shared by all workers through Redis, keyed by the service
+    account identity, and refreshed shortly before it expires.
+
+    Returns:
+        dict: `token`, `project_id` and `expires_at` (unix timestamp)
+    """
+    info = get_service_account_info()
+    cache = frappe.cache()
+    key = get_token_cache_key(info)
+
+    entry = _get_cached_token(key)
+    if entry:
+        metrics.incr("token_cache_requests", result="hit")
+        return entry
+
+    try:
+        with cache.lock(
+            cache.make_key(f"{key}:lock"),
+            timeout=REFRESH_LOCK_TIMEOUT,
+            blocking_timeout=REFRESH_LOCK_WAIT
+        ):
+            # Another worker may have refreshed while we waited for the lock
+            entry = _get_cached_token(key)
+            if entry:
+                metrics.incr("token_cache_requests", result="hit")
+                return entry
+
+            metrics.incr("token_cache_requests", result="miss")
+            entry = refresh_access_token(info)
+            cache.set_value(
+                key,
+                entry,
+                expires_in_sec=max(int(entry["expires_at"] - time.time() - REFRESH_MARGIN), 1)
+            )
+            return entry
+    except LockError:
+        # The refreshing worker is stuck; do not block delivery on it
+        metrics.incr("token_cache_requests", result="miss")
+        return refresh_access_token(info)
+
+def refresh_access_token(info):
+    """
+    Fetch a new access token from Google's token endpoint.
+    """
+    try:
+        credentials = service_account.Credentials.from_service_account_info(
+            info,
+            scopes=[FCM_SCOPE]
+        )
+    except Exception as e:
+        frappe.throw(f"Error loading service account credentials: {e}")
+
+    # Fails fast with CircuitOpen while the token endpoint is down
+    breaker = get_circuit_breaker("oauth")
+    breaker.allow()
+
+    started = time.monotonic()
+    try:
+        credentials.refresh(get_token_request())
+    except Exception as e:
+        # Only network failures mean the endpoint is down; an answered request proves it is up
+        breaker.record(not isinstance(e, TransportError))
+        breaker.flush()
+        frappe.throw(f"Error getting OAuth 2.0 access token: {e}")
+    breaker.record(True)
+    breaker.flush()
+    metrics.observe("token_refresh_seconds", time.monotonic() - started)
+
+    return {
+        "token": credentials.token,
+        "project_id": credentials.project_id,
+        "expires_at": calendar.timegm(credentials.expiry.utctimetuple())
+    }
+
+def get_token_request():
+    """
+    google-auth transport for the token endpoint, with the HTTP timeouts of
+    FCM Notification Settings instead of its 120 second default.
+    """
+    settings = frappe.get_cached_doc("FCM Notification Settings")
+    timeout = (
+        flt(settings.connect_timeout) or DEFAULT_CONNECT_TIMEOUT,
+        flt(settings.read_timeout) or DEFAULT_READ_TIMEOUT
+    )
+    request = Request()
+
+    def request_with_timeout(*args, **kwargs):
+        kwargs.setdefault("timeout", timeout)
+        return request(*args, **kwargs)
+
+    return request_with_timeout
+
+def get_token_cache_key(info):
+    """
+    Cache key for the service account described by `info`.
+    """
+    identity = f"{info.get('client_email')}:{info.get('private_key_id')}"
+    return TOKEN_CACHE_PREFIX + hashlib.sha1(identity.encode()).hexdigest()
+
+def clear_access_token_cache():
+    """
+    Drop all cached access tokens, e.g. after the service account changed.
+    """
+    frappe.cache().delete_keys(TOKEN_CACHE_PREFIX)
+
+@frappe.whitelist()
+def get_token_cache_stats():
+    """
+    Return the access token cache hit/miss counters.
+    """
+    frappe.only_for("System Manager")
+    return {
+        "hits": metrics.get("token_cache_requests", result="hit"),
+        "misses": metrics.get("token_cache_requests", result="miss")
+    }
+
+def _get_cached_token(key):
+    entry = frappe.cache().get_value(key)
+    if entry and entry["expires_at"] - REFRESH_MARGIN > time.time():
+        return entry
@@ -0,0 +1,6 @@
+from fcm_notification.fcm_notification.doctype.fcm_notification.fcm_notification import (
+    on_doctype_update as add_fcm_notification_indexes
+)
+
+def execute():
+    add_fcm_notification_indexes()
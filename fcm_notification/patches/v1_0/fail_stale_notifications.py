@@ -0,0 +1,22 @@
+import frappe
+from frappe.utils import add_to_date, now_datetime
+
+# Rows younger than this may still be waiting for their delivery job
+STALE_AFTER_HOURS = 1
+
+def execute():
+    """
+    Mark FCM Notifications left NEW by earlier versions as FAILED.
+
+    Before the outbox dispatcher, a send that failed (or found no token) left
+    its row NEW forever. The dispatcher claims NEW rows, so without this it
+    would deliver months-old pushes, including broadcasts, right after the
+    upgrade.
+    """
+    FCMNotification = frappe.qb.DocType("FCM Notification")
+    (
+        frappe.qb.update(FCMNotification)
+        .set(FCMNotification.status, "FAILED")
+        .where(FCMNotification.status == "NEW")
+        .where(FCMNotification.creation < add_to_date(now_datetime(), hours=-STALE_AFTER_HOURS))
+    ).run()
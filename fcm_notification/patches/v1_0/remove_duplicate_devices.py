@@ -0,0 +1,25 @@
+import frappe
+
+def execute():
+    """
+    Keep only the latest User Device per device_id and device_token, so the
+    unique indexes on both fields can be created.
+    """
+    if not frappe.db.table_exists("User Device"):
+        return
+
+    for field in ("device_id", "device_token"):
+        duplicates = frappe.db.sql(
+            f"""select `{field}` from `tabUser Device`
+            where `{field}` is not null
+            group by `{field}` having count(*) > 1""",
+            pluck=True
+        )
+        for value in duplicates:
+            names = frappe.get_all(
+                "User Device",
+                filters={field: value},
+                order_by="modified desc",
+                pluck="name"
+            )
+            frappe.db.delete("User Device", {"name": ["in", names[1:]]})
@@ -0,0 +1,100 @@
+import time
+
+import frappe
+from frappe.utils import cint, flt
+
+# Defaults, overridable in FCM Notification Settings
+DEFAULT_MAX_WAIT = 10
+
+# The FCM quota is per project, so the bucket is deliberately not prefixed
+# with the site: every site, worker and bench node sending for the same
+# project on this Redis draws from it.
+RATE_LIMITER_KEY = "fcm_notification:rate_limiter:{project_id}"
+
+# Refill the bucket for the time elapsed, then take `requested` tokens if the
+# caller would not have to wait longer than `max_wait`. Tokens may go negative:
+# that reserves a slot for the caller, who sleeps for the returned wait.
+# A negative return value means "not reserved, wait at least this long".
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local max_wait = tonumber(ARGV[4])
+
+local clock = redis.call("TIME")
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+
+local state = redis.call("HMGET", KEYS[1], "tokens", "ts")
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+
+local wait = 0
+if tokens < requested then
+    wait = (requested - tokens) / rate
+end
+if wait > max_wait then
+    return tostring(-wait)
+end
+
+redis.call("HSET", KEYS[1], "tokens", tokens - requested, "ts", now)
+redis.call("EXPIRE", KEYS[1], math.ceil(burst / rate) + math.ceil(max_wait) + 1)
+return tostring(wait)
+"""
+
+class RateLimitExceeded(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"FCM rate limit reached, retry in {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+class RateLimiter:
+    """
+    Redis token bucket shared by every sender of an FCM project.
+
+    `acquire` blocks for up to `max_wait` seconds for a send slot and raises
+    RateLimitExceeded when the wait would be longer, so callers can requeue
+    instead of hammering the API.
+    """
+    def __init__(self, project_id, rate, burst=None, max_wait=DEFAULT_MAX_WAIT):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.max_wait = max_wait
+        self.key = RATE_LIMITER_KEY.format(project_id=project_id)
+        self.script = frappe.cache().register_script(TOKEN_BUCKET_SCRIPT) if rate else None
+        # Once refused, refuse locally until the bucket can have refilled
+        self.refused_until = 0
+        self.waits = 0
+        self.waited = 0.0
+
+    def acquire(self):
+        """
+        Wait for a send slot; return the seconds waited.
+        """
+        if not self.script:
+            return 0
+
+        if self.refused_until > time.monotonic():
+            raise RateLimitExceeded(self.refused_until - time.monotonic())
+
+        wait = float(self.script(keys=[self.key], args=[self.rate, self.burst, 1, self.max_wait]))
+        if wait < 0:
+            self.refused_until = time.monotonic() - wait
+            raise RateLimitExceeded(-wait)
+
+        if wait:
+            time.sleep(wait)
+            self.waits += 1
+            self.waited += wait
+        return wait
+
+def get_rate_limiter(project_id):
+    """
+    Return a RateLimiter configured from FCM Notification Settings.
+    """
+    settings = frappe.get_cached_doc("FCM Notification Settings")
+    return RateLimiter(
+        project_id,
+        rate=flt(settings.rate_limit),
+        burst=cint(settings.rate_limit_burst),
+        max_wait=flt(settings.rate_limit_max_wait) or DEFAULT_MAX_WAIT
+    )
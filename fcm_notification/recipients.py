@@ -0,0 +1,40 @@
+import frappe
+
+# HD Team name -> member users, invalidated when the team changes
+HD_TEAM_USERS_KEY = "fcm_notification:hd_team_users"
+
+def get_user_devices(users):
+    """
+    Return the active devices of `users` in a single query.
+
+    Every device of a user is returned, so someone with a phone and a tablet
+    gets the push on both.
+
+    Returns:
+        list: dicts with `name`, `user` and `device_token`
+    """
+    users = list(dict.fromkeys(filter(None, users)))
+    if not users:
+        return []
+
+    return frappe.get_all(
+        "User Device",
+        filters={"user": ["in", users], "disabled": 0},
+        fields=["name", "user", "device_token"],
+        order_by="user asc"
+    )
+
+def get_hd_team_users(team):
+    """
+    Return the users of an HD Team, cached until the team changes.
+    """
+    if not team:
+        return []
+
+    def generator():
+        return [row.user for row in frappe.get_doc("HD Team", team).get("users") or []]
+
+    return frappe.cache().hget(HD_TEAM_USERS_KEY, team, generator=generator)
+
+def clear_hd_team_cache(doc, method=None):
+    frappe.cache().hdel(HD_TEAM_USERS_KEY, doc.name)
@@ -0,0 +1,135 @@
+import time
+
+import frappe
+from frappe.query_builder.functions import Count, Date, Sum
+from frappe.utils import add_days, cint, getdate, now_datetime
+
+from fcm_notification import metrics
+
+# Finished statuses and the settings field holding their retention in days
+RETENTION_FIELDS = {
+    "SENT": "sent_retention_days",
+    "FAILED": "failed_retention_days",
+}
+# Defaults, overridable in FCM Notification Settings
+DEFAULT_RETENTION_DAYS = {
+    "SENT": 30,
+    "FAILED": 90,
+}
+DEFAULT_BATCH_SIZE = 500
+# A run stops after this many seconds; the next one continues where it stopped
+RETENTION_TIME_BUDGET = 900
+
+def purge_old_notifications():
+    """
+    Scheduled job: remove finished FCM Notifications past their retention period.
+
+    Rows are removed oldest first in small batches, each committed on its
+    own, so no lock is held for long. Pending rows (NEW, CLAIMED, RETRY) are
+    never removed.
+
+    Returns:
+        dict: rows removed per status
+    """
+    settings = frappe.get_cached_doc("FCM Notification Settings")
+    batch_size = cint(settings.retention_batch_size) or DEFAULT_BATCH_SIZE
+    deadline = time.monotonic() + RETENTION_TIME_BUDGET
+
+    removed = {}
+    for status in RETENTION_FIELDS:
+        days = get_retention_days(settings, status)
+        if not days:
+            continue
+
+        cutoff = add_days(now_datetime(), -days)
+        removed[status] = 0
+        while time.monotonic() < deadline:
+            names = frappe.get_all(
+                "FCM Notification",
+                filters={"status": status, "creation": ["<", cutoff]},
+                order_by="creation asc",
+                limit=batch_size,
+                pluck="name"
+            )
+            if not names:
+                break
+
+            if cint(settings.roll_up_before_purge):
+                roll_up_notifications(names)
+            delete_notifications(names)
+            frappe.db.commit()
+
+            removed[status] += len(names)
+            metrics.incr("notifications_purged", len(names), status=status)
+
+    frappe.db.set_single_value("FCM Notification Settings", {
+        "last_retention_run": now_datetime(),
+        "last_retention_removed": sum(removed.values())
+    })
+    frappe.db.commit()
+    return removed
+
+def get_retention_days(settings, status):
+    """
+    Retention of `status` in days; 0 keeps the rows forever.
+    """
+    days = settings.get(RETENTION_FIELDS[status])
+    if days is None:
+        return DEFAULT_RETENTION_DAYS[status]
+    return cint(days)
+
+def roll_up_notifications(names):
+    """
+    Add the notifications `names` to their day's FCM Notification Daily Count.
+    """
+    Notification = frappe.qb.DocType("FCM Notification")
+    day = Date(Notification.creation)
+    rows = (
+        frappe.qb.from_(Notification)
+        .select(
+            day.as_("date"),
+            Notification.status,
+            Notification.reference_doctype,
+            Notification.reference_name,
+            Count("*").as_("notification_count"),
+            Sum(Notification.sent_count).as_("sent_count"),
+            Sum(Notification.failed_count).as_("failed_count")
+        )
+        .where(Notification.name.isin(names))
+        .groupby(day, Notification.status, Notification.reference_doctype, Notification.reference_name)
+    ).run(as_dict=True)
+
+    DailyCount = frappe.qb.DocType("FCM Notification Daily Count")
+    for row in rows:
+        existing = frappe.db.get_value("FCM Notification Daily Count", {
+            "date": row.date,
+            "status": row.status,
+            "reference_doctype": row.reference_doctype,
+            "reference_name": row.reference_name
+        })
+        if existing:
+            (
+                frappe.qb.update(DailyCount)
+                .set(DailyCount.notification_count, DailyCount.notification_count + cint(row.notification_count))
+                .set(DailyCount.sent_count, DailyCount.sent_count + cint(row.sent_count))
+                .set(DailyCount.failed_count, DailyCount.failed_count + cint(row.failed_count))
+                .where(DailyCount.name == existing)
+            ).run()
+        else:
+            frappe.get_doc({
+                "doctype": "FCM Notification Daily Count",
+                "date": getdate(row.date),
+                "status": row.status,
+                "reference_doctype": row.reference_doctype,
+                "reference_name": row.reference_name,
+                "notification_count": cint(row.notification_count),
+                "sent_count": cint(row.sent_count),
+                "failed_count": cint(row.failed_count)
+            }).insert(ignore_permissions=True)
+
+def delete_notifications(names):
+    """
+    Delete the notifications `names` together with their recipient rows.
+    """
+    frappe.db.delete("FCM Notification Recipient", {"parenttype": "FCM Notification", "parent": ["in", names]})
+    frappe.db.delete("FCM Notification", {"name": ["in", names]})
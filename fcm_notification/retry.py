@@ -0,0 +1,46 @@
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+from frappe.utils import add_to_date, cint, now_datetime
+
+# Defaults, overridable in FCM Notification Settings
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_BASE_DELAY = 30
+DEFAULT_MAX_DELAY = 3600
+
+def get_retry_after(result):
+    """
+    Return the `Retry-After` of a SendResult in seconds, or 0.
+
+    FCM sends either a number of seconds or an HTTP date.
+    """
+    value = (result.headers or {}).get("Retry-After")
+    if not value:
+        return 0
+    if value.strip().isdigit():
+        return int(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return 0
+    return max(int(retry_at.timestamp() - time.time()), 0)
+
+def get_retry_delay(attempt, retry_after=0, settings=None):
+    """
+    Seconds to wait before retry number `attempt` (starting at 1).
+
+    Exponential backoff with full jitter, so workers retrying the same brownout
+    spread out instead of hitting FCM together, but never sooner than FCM asked
+    for with `Retry-After`.
+    """
+    base_delay = cint(settings and settings.retry_base_delay) or DEFAULT_BASE_DELAY
+    max_delay = cint(settings and settings.retry_max_delay) or DEFAULT_MAX_DELAY
+    delay = random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+    return max(delay, retry_after)
+
+def get_next_retry_at(attempt, retry_after=0, settings=None):
+    return add_to_date(now_datetime(), seconds=get_retry_delay(attempt, retry_after, settings))
+
+def get_max_attempts(settings):
+    return cint(settings.max_attempts) or DEFAULT_MAX_ATTEMPTS
@@ -0,0 +1,175 @@
+import ast
+import builtins
+
+import frappe
+from frappe.utils import add_days, cint, cstr, date_diff, flt, getdate, now_datetime, nowdate
+from frappe.utils.safe_exec import UNSAFE_ATTRIBUTES
+
+# Builtins and helpers available to rule conditions; nothing else is reachable
+SAFE_BUILTINS = {
+    name: getattr(builtins, name)
+    for name in (
+        "abs", "all", "any", "bool", "dict", "float", "int", "isinstance", "len",
+        "list", "max", "min", "round", "set", "sorted", "str", "sum", "tuple"
+    )
+}
+SAFE_GLOBALS = {
+    "__builtins__": SAFE_BUILTINS,
+    "add_days": add_days,
+    "cint": cint,
+    "cstr": cstr,
+    "date_diff": date_diff,
+    "flt": flt,
+    "getdate": getdate,
+    "now_datetime": now_datetime,
+    "nowdate": nowdate,
+}
+
+# Redis copy of the rule index, shared by all workers
+RULES_CACHE_KEY = "fcm_notification:rules"
+# Changes whenever a Notification changes, so processes drop their local copy
+RULES_VERSION_KEY = "fcm_notification:rules_version"
+
+# Process level copy of the rule index: {site: (version, index)}
+_rule_index = {}
+# Compiled rules: {(site, rule name): (modified, CompiledRule)}
+_compiled_rules = {}
+
+class CompiledRule:
+    """
+    Condition and templates of an FCM rule, parsed once.
+
+    The condition is a code object evaluated against a restricted set of
+    globals; subject and message are compiled Jinja templates.
+    """
+    def __init__(self, rule):
+        self.name = rule.name
+        self.condition = compile_condition(rule.condition, rule.name) if rule.condition else None
+
+        jenv = frappe.get_jenv()
+        self.subject = jenv.from_string(rule.subject or rule.get("message_title") or "Document: {{ doc }}")
+        self.message = jenv.from_string(rule.message or "")
+
+    def matches(self, doc):
+        return not self.condition or bool(eval(self.condition, SAFE_GLOBALS, {"doc": doc}))
+
+    def render(self, doc):
+        """
+        Return the rendered `(subject, message)` for `doc`.
+        """
+        context = {"doc": doc}
+        return self.subject.render(context), self.message.render(context)
+
+def get_compiled_rule(rule):
+    """
+    Return the CompiledRule for `rule`, compiling it on first use or after it changed.
+    """
+    key = (frappe.local.site, rule.name)
+    modified = str(rule.modified)
+    cached = _compiled_rules.get(key)
+    if cached and cached[0] == modified:
+        return cached[1]
+
+    compiled = CompiledRule(rule)
+    _compiled_rules[key] = (modified, compiled)
+    return compiled
+
+def compile_condition(condition, rule_name=None):
+    """
+    Compile a rule condition to a code object.
+
+    Names and attributes starting with an underscore, and the attributes
+    Frappe's own `safe_eval` refuses (`format`, `format_map`, frame and
+    generator internals), are rejected. `str.format` would otherwise reach
+    `doc.__init__.__globals__` through a format string, which no name check
+    sees. Together with the restricted globals this keeps conditions from
+    reaching anything but the document and a few helpers.
+    """
+    try:
+        tree = ast.parse(condition.strip(), mode="eval")
+    except SyntaxError as e:
+        frappe.throw(f"Invalid condition for FCM rule {rule_name}: {e}")
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.NamedExpr):
+            frappe.throw(f"Invalid condition for FCM rule {rule_name}: assignment expressions are not allowed")
+
+        if isinstance(node, ast.Attribute):
+            name = node.attr
+        elif isinstance(node, ast.Name):
+            name = node.id
+        else:
+            continue
+        if name.startswith("_") or name in UNSAFE_ATTRIBUTES:
+            frappe.throw(f"Invalid condition for FCM rule {rule_name}: access to {name} is not allowed")
+
+    return compile(tree, f"<FCM rule {rule_name or ''}>", "eval")
+
+def get_rules(doctype):
+    """
+    Return the enabled FCM rules (Notifications) for `doctype`.
+
+    Doctypes without rules cost a dict lookup: the index is held in process
+    memory, backed by Redis, and only rebuilt from the database after a
+    Notification changed.
+    """
+    return get_rule_index().get(doctype) or []
+
+def get_rule_index():
+    """
+    Return `{doctype: [rule, ...]}` for all enabled FCM Notifications.
+    """
+    site = frappe.local.site
+    version = frappe.cache().get_value(RULES_VERSION_KEY)
+    cached = _rule_index.get(site)
+    if cached and version and cached[0] == version:
+        return cached[1]
+
+    if not version:
+        version = frappe.generate_hash(length=10)
+        frappe.cache().set_value(RULES_VERSION_KEY, version)
+
+    index = frappe.cache().get_value(RULES_CACHE_KEY, generator=build_rule_index)
+    _rule_index[site] = (version, index)
+    return index
+
+def build_rule_index():
+    rules = frappe.get_all(
+        "Notification",
+        filters={
+            "enabled": 1,
+            "channel": "FCM"
+        },
+        fields=["*"]
+    )
+
+    recipients = {}
+    if rules:
+        for row in frappe.get_all(
+            "Notification Recipient",
+            filters={"parenttype": "Notification", "parent": ["in", [rule.name for rule in rules]]},
+            fields=["parent", "owner", "receiver_by_document_field", "receiver_by_role"],
+            order_by="idx asc"
+        ):
+            recipients.setdefault(row.pop("parent"), []).append(row)
+
+    index = {}
+    for rule in rules:
+        rule.recipients = recipients.get(rule.name, [])
+        index.setdefault(rule.document_type, []).append(rule)
+    return index
+
+def clear_rules_cache():
+    frappe.cache().delete_value(RULES_CACHE_KEY)
+    frappe.cache().set_value(RULES_VERSION_KEY, frappe.generate_hash(length=10))
+
+def invalidate_rules_cache():
+    """
+    Drop the rule index now and again once the current transaction commits,
+    so no worker keeps rules rebuilt from data that was not yet committed.
+    """
+    clear_rules_cache()
+    frappe.db.after_commit.add(clear_rules_cache)
+
+def on_notification_trash(doc, method=None):
+    invalidate_rules_cache()
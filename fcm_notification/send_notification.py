@@ -1,57 +1,267 @@
 import frappe
-import requests
 import json
+import math
 import time
-from google.oauth2 import service_account
-from google.auth.transport.requests import Request
+from collections import deque
+from frappe.utils import add_to_date, cint, flt, now_datetime
 
-def send_fcm_message(doc, method):
+from fcm_notification import metrics
+from fcm_notification.bulk import in_bulk_operation, record_touched_document
+from fcm_notification.circuit_breaker import CircuitOpen, get_circuit_breaker, is_endpoint_failure
+from fcm_notification.digest import add_to_digest
+from fcm_notification.dispatcher import HANDOVER_CLAIM, claim_notification, get_lease_expiry
+from fcm_notification.dedupe import claim_idempotency_keys, get_idempotency_key
+from fcm_notification.oauth import get_access_token
+from fcm_notification.recipients import get_hd_team_users, get_user_devices
+from fcm_notification.rate_limiter import RateLimitExceeded, get_rate_limiter
+from fcm_notification.rules import compile_condition, get_compiled_rule, get_rules, invalidate_rules_cache
+from fcm_notification.retry import get_max_attempts, get_next_retry_at, get_retry_after
+from fcm_notification.fcm_notification.doctype.user_device.user_device import disable_device_tokens
+from fcm_notification.sender import (
+    DEFAULT_CONCURRENCY,
+    OUTCOME_DEAD_TOKEN,
+    OUTCOME_SENT,
+    OUTCOME_TRANSIENT,
+    SendResult,
+    classify_result,
+    send_message,
+    send_to_tokens
+)
+from fcm_notification.topics import get_site_topic
+from fcm_notification.transport import get_headers, get_send_url, get_transport
+
+# Background job defaults, overridable in FCM Notification Settings
+DEFAULT_QUEUE = "default"
+DEFAULT_HIGH_PRIORITY_QUEUE = "short"
+DEFAULT_BROADCAST_QUEUE = "long"
+DEFAULT_JOB_TIMEOUT = 1500
+
+# Per-token broadcasts read devices in pages of this size, checkpoint after
+# each one and give way to pending high priority notifications between them
+BROADCAST_CHUNK_SIZE = 500
+
+# FCM Notification priority -> (Android priority, APNs priority)
+MESSAGE_PRIORITIES = {
+    "High": ("high", "10"),
+    "Low": ("normal", "5"),
+}
+
+def enqueue_fcm_message(doc, method=None):
     """
-    Send a message to Firebase when the status is "NEW".
+    Queue delivery of a newly inserted FCM Notification.
+
+    The insert only persists the row; credentials, the OAuth refresh and the
+    HTTP calls to FCM run in a background worker once the transaction commits.
     """
-    # Verify if the status is "NEW"
     if doc.status != "NEW":
         return
 
-    # Verify if the user has a configured FCM Token
-    if not doc.all_users and not frappe.db.get_value("User Device", doc.user, "device_token"):
-        print("DEBUG: User does not have a configured FCM Token, exiting...")
-        return
+    settings = frappe.get_cached_doc("FCM Notification Settings")
+    frappe.enqueue(
+        "fcm_notification.send_notification.deliver_fcm_notification",
+        queue=get_delivery_queue(doc, settings),
+        timeout=cint(settings.job_timeout) or DEFAULT_JOB_TIMEOUT,
+        job_name=f"fcm_notification:{doc.name}",
+        enqueue_after_commit=True,
+        notification=doc.name
+    )
 
-    # Get the path to the service account JSON file
-    service_account_json = frappe.db.get_single_value("FCM Notification Settings", "server_key")
-    if not service_account_json:
-        frappe.throw("The service account JSON content is not configured in FCM Notification Settings.")
+def get_delivery_queue(doc, settings):
+    """
+    Return the queue (lane) for delivering `doc`.
 
-    # Load the service account credentials
-    try:
-        service_account_info = json.loads(service_account_json)
-        credentials = service_account.Credentials.from_service_account_info(
-            service_account_info,
-            scopes=["https://www.googleapis.com/auth/firebase.messaging"]
+    Broadcasts and low priority pushes go to the broadcast lane, so a large
+    broadcast never delays high priority targeted pushes such as assignments.
+    """
+    if doc.all_users or doc.priority == "Low":
+        return settings.broadcast_queue or DEFAULT_BROADCAST_QUEUE
+    if doc.priority == "High":
+        return settings.high_priority_queue or DEFAULT_HIGH_PRIORITY_QUEUE
+    return settings.queue_name or DEFAULT_QUEUE
+
+def has_pending_high_priority_notifications():
+    """
+    Whether High priority FCM Notifications are waiting to be sent.
+
+    Looks at the outbox rather than the high priority queue, which other
+    jobs (including this app's topic syncs) share.
+    """
+    return bool(frappe.db.sql(
+        """select name from `tabFCM Notification`
+        where priority = 'High'
+            and (status = 'NEW'
+                or (status = 'RETRY' and next_retry_at <= %(now)s)
+                or (status = 'CLAIMED' and claimed_by = %(handover)s))
+        limit 1""",
+        {"now": now_datetime(), "handover": HANDOVER_CLAIM}
+    ))
+
+class ChunkTracker:
+    """
+    Streams the tokens of a chunked audience into the sender and reports
+    when chunks have completed.
+
+    A chunk is complete once a result came back for each of its tokens and
+    for every earlier chunk, so its cursor is a safe point to resume from.
+    Tokens keep flowing across chunk boundaries; only tokens in flight are
+    tracked.
+    """
+    def __init__(self, chunks, should_stop=None):
+        self.chunks = chunks
+        self.should_stop = should_stop
+        self.stopped = False
+        self.last_cursor = None
+        self.in_flight = {}
+        self.open_chunks = deque()
+
+    def tokens(self):
+        chunks = iter(self.chunks)
+        first = True
+        while True:
+            # Asked before the next page is read, so stopping never reads one
+            if not first and self.should_stop and self.should_stop():
+                self.stopped = True
+                return
+
+            chunk = next(chunks, None)
+            if chunk is None:
+                return
+            first = False
+
+            cursor, tokens = chunk
+            chunk = [cursor, len(tokens)]
+            self.open_chunks.append(chunk)
+            for token in tokens:
+                self.in_flight[token] = chunk
+                yield token
+
+    def complete(self, token):
+        """
+        Record the result for `token`; return the cursor of the newest chunk
+        completed by it, if any.
+        """
+        chunk = self.in_flight.pop(token, None)
+        if chunk:
+            chunk[1] -= 1
+
+        completed = None
+        while self.open_chunks and self.open_chunks[0][1] <= 0:
+            completed = self.open_chunks.popleft()[0]
+        if completed:
+            self.last_cursor = completed
+        return completed
+
+def iter_broadcast_chunks(cursor=None):
+    """
+    Yield `(last_device_name, tokens)` for all active devices, in chunks of
+    BROADCAST_CHUNK_SIZE, starting after the device named `cursor`.
+    """
+    while True:
+        filters = {"disabled": 0}
+        if cursor:
+            filters["name"] = [">", cursor]
+
+        devices = frappe.get_all(
+            "User Device",
+            filters=filters,
+            fields=["name", "device_token"],
+            order_by="name asc",
+            limit_page_length=BROADCAST_CHUNK_SIZE
         )
-    except Exception as e:
-        frappe.throw(f"Error loading service account credentials: {e}")
+        if not devices:
+            return
 
-    # Get the OAuth 2.0 access token
+        cursor = devices[-1].name
+        yield cursor, [device.device_token for device in devices]
+
+def deliver_fcm_notification(notification, handover=False):
+    """
+    Background job: send a queued FCM Notification.
+
+    The row is claimed first, so it is never sent by both this job and the
+    outbox dispatcher. `handover` jobs take over a row the dispatcher
+    claimed and routed to this job's lane.
+    """
+    if not claim_notification(notification, handover=handover):
+        return
+
+    doc = frappe.get_doc("FCM Notification", notification)
+    send_fcm_message(doc)
+
+def send_fcm_message(doc, method=None):
+    """
+    Send a message to Firebase when the status is "NEW", "CLAIMED" or a retry is due.
+
+    Transient failures (429, 5xx, network errors) are rescheduled with
+    exponential backoff; after the last attempt the status becomes "FAILED".
+    """
+    # Verify if the status is pending
+    if doc.status not in ("NEW", "CLAIMED", "RETRY"):
+        return
+
+    # Rows claimed by a dispatcher already counted this attempt
+    attempts = cint(doc.attempts) + (0 if doc.status == "CLAIMED" else 1)
+
+    # Verify if the user has a configured FCM Token
+    user_token = None
+    if not doc.all_users and not doc.recipients:
+        user_token = get_user_fcm_token(doc.user)
+        if not user_token:
+            frappe.db.set_value("FCM Notification", doc.name, {
+                "status": "FAILED",
+                "attempts": attempts,
+                "claimed_by": None,
+                "lease_expires_at": None
+            })
+            frappe.db.commit()
+            return
+
+    # While FCM or the token endpoint is down, leave the row to the dispatcher
+    breaker = get_circuit_breaker("fcm")
     try:
-        credentials.refresh(Request())
-        access_token = credentials.token
-    except Exception as e:
-        frappe.throw(f"Error getting OAuth 2.0 access token: {e}")
-
-    users_to_notify = []
-    if doc.all_users:
-        for user in frappe.get_all("User Device", fields=['device_token']):
-            users_to_notify.append(user.device_token)
+        breaker.allow()
+        # Get the OAuth 2.0 access token, shared across workers
+        access_token = get_access_token()
+    except CircuitOpen as e:
+        # Not an attempt; the dispatcher picks the row up once the circuit may close
+        frappe.db.set_value("FCM Notification", doc.name, {
+            "status": "RETRY",
+            "attempts": attempts - 1,
+            "next_retry_at": add_to_date(now_datetime(), seconds=math.ceil(e.retry_after)),
+            "claimed_by": None,
+            "lease_expires_at": None
+        })
+        frappe.db.commit()
+        return
+
+    settings = frappe.get_cached_doc("FCM Notification Settings")
+    broadcast_topic = get_site_topic() if doc.all_users and cint(settings.use_topic_broadcast) else None
+
+    # Set when a per-token broadcast stopped early (high priority work, refused sends) or was interrupted
+    resumed_broadcast = bool(doc.broadcast_cursor)
+
+    if broadcast_topic:
+        # A single topic message reaches every subscribed device
+        chunks = []
+    elif doc.pending_tokens and not resumed_broadcast:
+        # Only the tokens that failed transiently last time
+        chunks = [(None, json.loads(doc.pending_tokens))]
+    elif doc.all_users:
+        # Stream the audience, continuing after the last checkpoint
+        chunks = iter_broadcast_chunks(doc.broadcast_cursor)
+    elif doc.recipients:
+        # Tokens were resolved when the notification was created
+        chunks = [(None, [recipient.device_token for recipient in doc.recipients])]
     else:
-        users_to_notify.append(get_user_fcm_token(doc.user))
+        chunks = [(None, [user_token])]
 
-    with open("/tmp/users_to_notify.txt", "a+") as f:
-        f.write(f"Users to notify({len(users_to_notify)}): {users_to_notify}")
+    # The URL and headers are the same for every token of this notification
+    transport = get_transport()
+    url = get_send_url(access_token["project_id"])
+    headers = get_headers(access_token["token"])
+    concurrency = cint(settings.max_concurrency) or DEFAULT_CONCURRENCY
 
-    for token_to_notify in users_to_notify:
-        # Build the message payload
+    def build_message(token_to_notify=None, topic=None):
         message = {
             "message": {
                 "notification": {
@@ -59,47 +269,208 @@ def send_fcm_message(doc, method):
                     "body": doc.message
                 },
                 "token": token_to_notify,
-                "topic": None
+                "topic": topic
             }
         }
 
         # Remove keys with None value
         message["message"] = {k: v for k, v in message["message"].items() if v is not None}
 
-        # Endpoint API HTTP v1
-        project_id = credentials.project_id
-        url = f"https://fcm.googleapis.com/v1/projects/{project_id}/messages:send"
+        android, apns_headers = {}, {}
+        if doc.priority in MESSAGE_PRIORITIES:
+            android["priority"], apns_headers["apns-priority"] = MESSAGE_PRIORITIES[doc.priority]
+        if doc.collapse_key:
+            # Devices only keep the latest push with this key
+            android["collapse_key"] = doc.collapse_key
+            android["notification"] = {"tag": doc.collapse_key}
+            apns_headers["apns-collapse-id"] = doc.collapse_key
+        if android:
+            message["message"]["android"] = android
+            message["message"]["apns"] = {"headers": apns_headers}
+        return message
 
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json; UTF-8",
-        }
+    # Shared with every worker sending for this project
+    limiter = get_rate_limiter(access_token["project_id"])
+    # Seconds until sends may be allowed again, once one was refused locally
+    refused_for = None
+
+    def throttle(target):
+        nonlocal refused_for
+        try:
+            breaker.check()
+            limiter.acquire()
+        except CircuitOpen as e:
+            # The circuit opened during this run; requeue the rest without calling FCM
+            refused_for = max(refused_for or 0, e.retry_after)
+            return SendResult(target, None, str(e), {"Retry-After": str(math.ceil(e.retry_after))}, e)
+        except RateLimitExceeded as e:
+            # Requeue through the retry schedule instead of calling FCM
+            refused_for = max(refused_for or 0, e.retry_after)
+            return SendResult(target, 429, str(e), {"Retry-After": str(math.ceil(e.retry_after))}, e)
 
-        response = requests.post(url, headers=headers, data=json.dumps(message))
+    sent_count = failed_count = 0
+    dead_tokens = []
+    # A resumed broadcast keeps the transient failures of its earlier slices
+    transient_tokens = json.loads(doc.pending_tokens) if resumed_broadcast and doc.pending_tokens else []
+    retry_after = 0
+    # Sends refused locally (rate limit, open circuit) by reason
+    deferred = {}
 
+    def process_result(result):
+        nonlocal sent_count, failed_count, retry_after
         # Validate the response
-        if response.status_code == 200:
-            frappe.db.set_value("FCM Notification", doc.name, "status", "SENT")
-            frappe.db.commit()
+        outcome = classify_result(result)
+        # Sends refused locally never reached the endpoint; they are retried
+        # later and summarized once per run instead of logged one by one
+        reason = get_deferral_reason(result)
+        if reason:
+            deferred[reason] = deferred.get(reason, 0) + 1
         else:
-            print(f"Error sending FCM message: {response.status_code} - {response.text}")
-            frappe.log_error(
-                f"Error sending FCM message: {response.status_code} - {response.text}",
-                "FCM Notification"
-            )
-        with open("/tmp/users_to_notify.txt", "a+") as f:
-            f.write(f"User to notify({token_to_notify}): Response: {response.status_code} - {response.text}")
+            breaker.record(not is_endpoint_failure(result))
+            metrics.incr("sends", outcome=outcome, code=result.status_code or "error")
+            if result.elapsed:
+                metrics.observe("send_latency_seconds", result.elapsed)
+        if outcome == OUTCOME_SENT:
+            sent_count += 1
+        else:
+            failed_count += 1
+            if outcome == OUTCOME_DEAD_TOKEN and not broadcast_topic:
+                dead_tokens.append(result.token)
+            elif outcome == OUTCOME_TRANSIENT:
+                transient_tokens.append(result.token)
+                retry_after = max(retry_after, get_retry_after(result))
+            if not reason:
+                frappe.log_error(
+                    f"Error sending FCM message: {result.status_code} - {result.text}",
+                    "FCM Notification"
+                )
+
+    pruned = 0
+
+    def checkpoint(cursor):
+        # Everything up to `cursor` is done; an interrupted broadcast resumes after it
+        nonlocal pruned
+        disable_device_tokens(dead_tokens[pruned:])
+        pruned = len(dead_tokens)
+        frappe.db.set_value("FCM Notification", doc.name, {
+            "broadcast_cursor": cursor,
+            "sent_count": cint(doc.sent_count) + sent_count,
+            "failed_count": cint(doc.failed_count) + failed_count,
+            "pruned_count": cint(doc.pruned_count) + len(dead_tokens),
+            "pending_tokens": json.dumps(transient_tokens) if transient_tokens else None,
+            "lease_expires_at": get_lease_expiry()
+        }, update_modified=False)
+        frappe.db.commit()
+
+    started = time.monotonic()
+    if broadcast_topic:
+        target = f"/topics/{broadcast_topic}"
+        process_result(throttle(target) or send_message(transport, url, headers, build_message(topic=broadcast_topic), target))
+
+    def should_stop():
+        # Only broadcasts stop early: once sends are refused, reading further
+        # pages would only pile their tokens up for a retry, and they give
+        # way to pending high priority notifications
+        return doc.all_users and (refused_for is not None or has_pending_high_priority_notifications())
+
+    tracker = ChunkTracker(chunks, should_stop)
+    for result in send_to_tokens(transport, url, headers, build_message, tracker.tokens(), concurrency, throttle):
+        process_result(result)
+        cursor = tracker.complete(result.token)
+        if cursor:
+            checkpoint(cursor)
+
+    broadcast_cursor = tracker.last_cursor if tracker.stopped else None
+    breaker.flush()
+
+    for reason, count in deferred.items():
+        metrics.incr("sends_deferred", count, reason=reason)
+    if deferred:
+        summary = ", ".join(f"{count} by the {reason.replace('_', ' ')}" for reason, count in deferred.items())
+        frappe.log_error(
+            f"FCM Notification {doc.name}: sends deferred to a retry ({summary})",
+            "FCM Notification"
+        )
+
+    elapsed = time.monotonic() - started
+    sends_per_second = flt((sent_count + failed_count) / elapsed, 2) if elapsed else 0
+    metrics.incr("rate_limiter_waits", limiter.waits)
+    metrics.incr("rate_limiter_wait_seconds", limiter.waited)
+
+    # Every pruned token is one send saved on each later broadcast
+    disable_device_tokens(dead_tokens[pruned:])
+    metrics.incr("tokens_pruned", len(dead_tokens))
+
+    sent_count += cint(doc.sent_count)
+    values = {
+        "attempts": attempts,
+        "sent_count": sent_count,
+        "failed_count": cint(doc.failed_count) + failed_count,
+        "sends_per_second": sends_per_second,
+        "pruned_count": cint(doc.pruned_count) + len(dead_tokens),
+        "next_retry_at": None,
+        "pending_tokens": None,
+        "broadcast_cursor": None,
+        "claimed_by": None,
+        "lease_expires_at": None
+    }
+
+    if broadcast_cursor:
+        # Stopping early is not an attempt; the next claim counts it again
+        values["attempts"] = attempts - 1
+        values["broadcast_cursor"] = broadcast_cursor
+        values["pending_tokens"] = json.dumps(transient_tokens) if transient_tokens else None
+        if refused_for is not None:
+            # The dispatcher resumes after the cursor once sends may be allowed
+            values["status"] = "RETRY"
+            values["next_retry_at"] = add_to_date(now_datetime(), seconds=math.ceil(refused_for))
+        else:
+            values["status"] = "NEW"
+    elif transient_tokens and attempts < get_max_attempts(settings):
+        values["status"] = "RETRY"
+        values["next_retry_at"] = get_next_retry_at(attempts, retry_after, settings)
+        if not broadcast_topic:
+            values["pending_tokens"] = json.dumps(transient_tokens)
+        metrics.incr("retries_scheduled")
+    else:
+        values["status"] = "SENT" if sent_count else "FAILED"
+
+    frappe.db.set_value("FCM Notification", doc.name, values)
+    frappe.db.commit()
+
+    if values["status"] == "NEW":
+        # Back of the broadcast lane, behind anything queued meanwhile
+        frappe.enqueue(
+            "fcm_notification.send_notification.deliver_fcm_notification",
+            queue=get_delivery_queue(doc, settings),
+            timeout=cint(settings.job_timeout) or DEFAULT_JOB_TIMEOUT,
+            job_name=f"fcm_notification:{doc.name}",
+            notification=doc.name
+        )
+
+def get_deferral_reason(result):
+    """
+    Return why a SendResult was refused before reaching FCM, or None.
+    """
+    if isinstance(result.error, RateLimitExceeded):
+        return "rate_limiter"
+    if isinstance(result.error, CircuitOpen):
+        return "circuit_breaker"
+    return None
 
 def get_user_fcm_token(user):
     """
     Get the FCM token from the User Device doctype.
     """
-    return frappe.db.get_value("User Device", user, "device_token")
+    return frappe.db.get_value("User Device", {"name": user, "disabled": 0}, "device_token")
 
 def notification_handler(doc, method):
     """
     Handle the notification before validation and create FCM notification based on conditions.
     """
+    # Any Notification change may add, change or remove an FCM rule
+    invalidate_rules_cache()
+
     if doc.channel != "FCM":
         return
 
@@ -110,73 +481,45 @@ def notification_handler(doc, method):
     if not doc.document_type:
         frappe.throw("Document Type is required for FCM notifications")
 
+    # Report broken or unsafe conditions on save rather than on every event
+    if doc.condition:
+        compile_condition(doc.condition, doc.name)
+
 def process_document_for_fcm(doc, method):
     """
     This function should be called when a monitored document is modified
     """
-    print(f"DEBUG: Process document for FCM called -> {doc}")
     # Search for all active FCM notifications for this document type
-    notifications = frappe.get_all(
-        "Notification",
-        filters={
-            "enabled": 1,
-            "channel": "FCM",
-            "document_type": doc.doctype
-        },
-        fields=["*"]
-    )
+    notifications = get_rules(doc.doctype)
 
     # If there are no notifications, return
     if not notifications:
-        print("DEBUG: No notifications found, exiting...")
         return
 
-    print(f"DEBUG: Notifications: {notifications}")
+    # Imports, patches and the like only record the document; rules run once it is done
+    if in_bulk_operation():
+        record_touched_document(doc)
+        return
 
     for notification in notifications:
         try:
             # Check the condition for the current document
-            print(f"DEBUG: Condition: {notification.condition}")
-            if notification.condition:
-                context = {"doc": doc}
-                if not eval(notification.condition, context):
-                    continue
-
-            print("DEBUG: Condition ok")
+            rule = get_compiled_rule(notification)
+            metrics.incr("rules_evaluated")
+            if not rule.matches(doc):
+                continue
+            metrics.incr("rules_matched")
 
             # Process the message template
-            subject = frappe.render_template(
-                notification.subject or notification.message_title or f"Document: {doc}",
-                context
-            )
-            message = frappe.render_template(notification.message, context)
-
-            print(f"DEBUG: Subject: {subject}")
-            print(f"DEBUG: Message: {message}")
-
-            # Determine recipients
-            # if doctype is HD Ticket, get users from agent_group field
-            if doc.doctype == "HD Ticket":
-                recp = {}
-                doc_hd_ticket = frappe.get_doc("HD Ticket", doc.name)
-                hd_team = frappe.get_doc("HD Team", doc_hd_ticket.agent_group)
-                if hd_team.get('users'):
-                    recp['recipients'] = [{'owner': i.get('user')} for i in hd_team.get('users')]
-            else:
-                recp = frappe.get_doc("Notification", notification.name, fields=['recipients']).as_dict()
-            print(f"DEBUG: Recipients: {recp.get('recipients')}")
-            if recp.get('recipients'):
-                for recipient_array in recp.get('recipients'):
-                    # Get device from User
-                    user_device = frappe.get_value("User Device", {'user': recipient_array.get('owner')}, 'name')
-                    # Create FCM notification for each recipient
-                    if user_device:
-                        create_fcm_notification(subject, message, user_device, False, doc)
-                        print(f"DEBUG: Create FCM notification for recipient: {recipient_array.get('owner')}")
-            else:
-                # Create FCM notification for all users
-                create_fcm_notification(subject, message, None, True, doc)
-                print("DEBUG: Create FCM notification for all users")  
+            subject, message = rule.render(doc)
+
+            users = get_rule_users(notification, doc)
+            if users is None:
+                notify_all_users(notification, doc, subject, message)
+            elif users:
+                # All active devices of all recipients, in one query
+                devices = get_user_devices(users)
+                notify_devices(notification, doc, subject, message, devices)
 
         except Exception as e:
             frappe.log_error(
@@ -184,11 +527,78 @@ def process_document_for_fcm(doc, method):
                 "FCM Notification Error"
             )
 
-def create_fcm_notification(subject, message, user=None, all_users=False, reference_doc=None):
+def get_rule_users(notification, doc):
+    """
+    Return the users `notification` notifies about `doc`.
+
+    None means all users, which only rules without recipients do. An HD
+    Ticket goes to the members of its team, so a ticket without a team, or
+    with a team without members, notifies nobody.
+    """
+    # if doctype is HD Ticket, get users from agent_group field
+    if doc.doctype == "HD Ticket":
+        return get_hd_team_users(doc.get("agent_group"))
+    if not notification.recipients:
+        return None
+    return [recipient.get("owner") for recipient in notification.recipients]
+
+def notify_devices(notification, doc, subject, message, devices, digest_window=None):
+    """
+    Push `subject` and `message` to `devices`, or buffer it in a digest.
+
+    `digest_window` defaults to the Digest Window of the rule.
+    """
+    # Drop devices another hook of this user action already notified
+    keys = [
+        get_idempotency_key(notification.name, doc.doctype, doc.name, device.name, subject, message)
+        for device in devices
+    ]
+    devices = [device for device, new in zip(devices, claim_idempotency_keys(keys)) if new]
+    if digest_window is None:
+        digest_window = cint(notification.get("fcm_digest_window"))
+
+    if devices and digest_window:
+        # Buffered and sent later as one summary per user
+        add_to_digest(
+            notification.name,
+            {device.user for device in devices},
+            subject,
+            message,
+            digest_window,
+            doc,
+            priority=notification.get("fcm_priority")
+        )
+    # One FCM notification for all devices of this rule
+    elif devices:
+        create_fcm_notification(
+            subject,
+            message,
+            reference_doc=doc,
+            recipients=devices,
+            priority=notification.get("fcm_priority")
+        )
+
+def notify_all_users(notification, doc, subject, message):
+    """
+    Create FCM notification for all users
+    """
+    key = get_idempotency_key(notification.name, doc.doctype, doc.name, "*", subject, message)
+    if claim_idempotency_keys([key])[0]:
+        create_fcm_notification(subject, message, None, True, doc, priority=notification.get("fcm_priority"))
+
+def create_fcm_notification(subject, message, user=None, all_users=False, reference_doc=None, recipients=None,
+                            collapse_key=None, digest_count=0, priority=None):
     """
     Create FCM notification document
+
+    `recipients` is a list of User Device dicts (`name`, `user`, `device_token`)
+    stored on the notification, so one record and one delivery job cover all
+    of them. The record is committed with the caller's transaction.
+
+    `collapse_key` makes devices replace an earlier push with the same key;
+    `digest_count` is the number of pushes a digest summarizes. `priority`
+    (High, Normal or Low) picks the delivery lane and the FCM message priority.
     """
-    print("DEBUG: Create FCM notification called")
     fcm_notification = frappe.get_doc({
         "doctype": "FCM Notification",
         "subject": subject,
@@ -197,8 +607,20 @@ def create_fcm_notification(subject, message, user=None, all_users=False, refere
         "all_users": all_users,
         "status": "NEW",
         "reference_doctype": reference_doc.doctype if reference_doc else None,
-        "reference_name": reference_doc.name if reference_doc else None
+        "reference_name": reference_doc.name if reference_doc else None,
+        "collapse_key": collapse_key,
+        "digest_count": digest_count,
+        "priority": priority or "Normal",
+        "recipients": [
+            {
+                "user_device": device.name,
+                "user": device.user,
+                "device_token": device.device_token
+            }
+            for device in recipients or []
+        ]
     })
-    
+
     fcm_notification.insert(ignore_permissions=True)
-    frappe.db.commit()
+    metrics.incr("notifications_created")
+    return fcm_notification
@@ -0,0 +1,117 @@
+import json
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+DEFAULT_CONCURRENCY = 8
+
+# Outcome of a single send. `status_code` is None when the request itself failed;
+# `elapsed` is the request latency in seconds.
+SendResult = namedtuple("SendResult", ["token", "status_code", "text", "headers", "error", "elapsed"],
+                        defaults=[0])
+
+# Classification of a SendResult
+OUTCOME_SENT = "sent"
+OUTCOME_DEAD_TOKEN = "dead_token"
+OUTCOME_TRANSIENT = "transient"
+OUTCOME_FAILED = "failed"
+
+# FCM error codes meaning the token will never work again
+DEAD_TOKEN_ERRORS = ("UNREGISTERED", "SENDER_ID_MISMATCH")
+TRANSIENT_ERRORS = ("QUOTA_EXCEEDED", "UNAVAILABLE", "INTERNAL")
+
+def send_message(transport, url, headers, message, target=None):
+    """
+    Send a single message and return its SendResult.
+    """
+    started = time.monotonic()
+    try:
+        response = transport.post(url, headers, json.dumps(message))
+    except Exception as e:
+        return SendResult(target, None, str(e), {}, e, time.monotonic() - started)
+    return SendResult(target, response.status_code, response.text, response.headers, None,
+                      time.monotonic() - started)
+
+def send_to_tokens(transport, url, headers, build_message, tokens, concurrency=DEFAULT_CONCURRENCY,
+                   before_send=None):
+    """
+    Send one message per token with at most `concurrency` requests in flight.
+
+    Tokens are pulled lazily from `tokens` and results are yielded as soon as
+    they complete, so memory stays bounded by `concurrency` whatever the size
+    of the audience. Worker threads only do HTTP; all database work stays
+    with the caller.
+
+    Args:
+        transport: FCMTransport used for the requests
+        url (str): FCM send endpoint
+        headers (dict): request headers, shared by every send
+        build_message (callable): returns the message payload for a token
+        tokens (iterable): device tokens to send to
+        concurrency (int): maximum number of concurrent requests
+        before_send (callable): called with each token before it is
+            submitted, in the caller's thread. Returning a SendResult skips
+            the request and yields that result instead.
+
+    Yields:
+        SendResult: one per token, in completion order
+    """
+    def send(token):
+        return send_message(transport, url, headers, build_message(token), token)
+
+    concurrency = max(concurrency, 1)
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="fcm-send") as executor:
+        pending = set()
+        for token in tokens:
+            skipped = before_send(token) if before_send else None
+            if skipped:
+                yield skipped
+                continue
+
+            pending.add(executor.submit(send, token))
+            if len(pending) >= concurrency:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+def get_error(result):
+    """
+    Return the `(code, message)` of an FCM error response.
+
+    The FCM specific code from the error details (e.g. `UNREGISTERED`) is
+    preferred over the generic status (e.g. `NOT_FOUND`).
+    """
+    try:
+        error = json.loads(result.text)["error"]
+    except (TypeError, ValueError, KeyError):
+        return None, result.text
+
+    code = error.get("status")
+    for detail in error.get("details") or []:
+        if detail.get("errorCode"):
+            code = detail["errorCode"]
+            break
+    return code, error.get("message")
+
+def classify_result(result):
+    """
+    Return one of the OUTCOME_* constants for a SendResult.
+    """
+    if result.status_code == 200:
+        return OUTCOME_SENT
+
+    code, message = get_error(result)
+    # Only FCM's own error codes prove a token dead; a bare 404 (wrong project,
+    # misrouted URL, proxy) would otherwise prune every device of a broadcast
+    if code in DEAD_TOKEN_ERRORS:
+        return OUTCOME_DEAD_TOKEN
+    if code == "INVALID_ARGUMENT" and "registration token" in (message or "").lower():
+        return OUTCOME_DEAD_TOKEN
+    if result.status_code is None or result.status_code == 429 or result.status_code >= 500 or code in TRANSIENT_ERRORS:
+        return OUTCOME_TRANSIENT
+    return OUTCOME_FAILED
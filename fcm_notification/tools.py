@@ -1,8 +1,13 @@
 import frappe
 from frappe import _
-from frappe.utils import now
+from frappe.utils import cint
 import traceback
 
+from fcm_notification.topics import enqueue_device_topic_sync
+
+# User Device fields set from the registration payload
+DEVICE_FIELDS = ("user", "device_id", "device_token", "device_name", "device_model", "os_version", "platform")
+
 @frappe.whitelist()
 def register_device(device_info):
     """
@@ -26,149 +31,17 @@ def register_device(device_info):
         frappe.ValidationError: If required fields are missing or invalid
     """
     try:
-        # Log the incoming request
-        frappe.log_error(
-            title="Device Registration - Incoming Request",
-            message=f"Raw device_info: {device_info}\nType: {type(device_info)}\nUser: {frappe.session.user}"
-        )
-        
-        if not isinstance(device_info, dict):
-            try:
-                device_info = frappe.parse_json(device_info)
-                frappe.log_error(
-                    title="Device Registration - JSON Parsed",
-                    message=f"Parsed device_info: {device_info}"
-                )
-            except Exception as parse_error:
-                frappe.log_error(
-                    title="Device Registration - JSON Parse Error",
-                    message=f"Failed to parse device_info: {device_info}\nError: {str(parse_error)}\nTraceback: {traceback.format_exc()}"
-                )
-                raise
-
-        # Validate required fields
-        required_fields = ['deviceId', 'fcmToken', 'platform']
-        for field in required_fields:
-            if not device_info.get(field):
-                error_msg = f"Missing required field: {field}"
-                frappe.log_error(
-                    title="Device Registration - Missing Field",
-                    message=f"Validation failed: {error_msg}\nDevice Info: {device_info}"
-                )
-                frappe.throw(_(error_msg))
-
-        # Validate platform
-        platform = device_info.get('platform')
-        if platform and platform.lower() not in ['android', 'ios']:
-            error_msg = "Platform must be either 'android' or 'ios'"
-            frappe.log_error(
-                title="Device Registration - Invalid Platform",
-                message=f"Validation failed: {error_msg}\nProvided platform: {platform}\nDevice Info: {device_info}"
-            )
-            frappe.throw(_(error_msg))
-
-        # Map the incoming data to DocType fields
-        device_data = {
-            "user": frappe.session.user,
-            "device_id": device_info.get('deviceId'),
-            "device_token": device_info.get('fcmToken'),
-            "device_name": device_info.get('deviceName'),
-            "device_model": device_info.get('deviceModel'),
-            "os_version": device_info.get('osVersion'),
-            "platform": device_info.get('platform').lower()
-        }
-        
-        frappe.log_error(
-            title="Device Registration - Mapped Data",
-            message=f"Mapped device_data: {device_data}"
-        )
+        trace("Device Registration - Incoming Request", f"Raw device_info: {device_info}\nUser: {frappe.session.user}")
 
-        # Check if device already exists
-        try:
-            existing_device = frappe.get_all(
-                "User Device",
-                filters={"device_id": device_data["device_id"]},
-                limit=1
-            )
-            
-            frappe.log_error(
-                title="Device Registration - Existing Device Check",
-                message=f"Existing device query result: {existing_device}\nFilter: device_id = {device_data['device_id']}"
-            )
-        except Exception as db_error:
-            frappe.log_error(
-                title="Device Registration - Database Query Error",
-                message=f"Error querying existing device: {str(db_error)}\nTraceback: {traceback.format_exc()}\nDevice ID: {device_data['device_id']}"
-            )
-            raise
-
-        if existing_device:
-            # Update existing device
-            try:
-                doc = frappe.get_doc("User Device", existing_device[0].name)
-                frappe.log_error(
-                    title="Device Registration - Updating Existing Device",
-                    message=f"Found existing device: {existing_device[0].name}\nOld data: {doc.as_dict()}\nNew data: {device_data}"
-                )
-                doc.update(device_data)
-                doc.save()
-                frappe.db.commit()
-                
-                frappe.log_error(
-                    title="Device Registration - Update Success",
-                    message=f"Device updated successfully: {doc.name}"
-                )
-                
-                return {
-                    "status": "success",
-                    "message": "Device updated successfully",
-                    "device": doc.name
-                }
-            except Exception as update_error:
-                frappe.log_error(
-                    title="Device Registration - Update Error",
-                    message=f"Error updating device: {str(update_error)}\nTraceback: {traceback.format_exc()}\nDevice: {existing_device[0].name}\nData: {device_data}"
-                )
-                raise
-        else:
-            # Create new device
-            try:
-                doc = frappe.get_doc({
-                    "doctype": "User Device",
-                    **device_data
-                })
-                
-                frappe.log_error(
-                    title="Device Registration - Creating New Device",
-                    message=f"Creating new device with data: {device_data}"
-                )
-                
-                doc.insert()
-                frappe.db.commit()
-                
-                frappe.log_error(
-                    title="Device Registration - Create Success",
-                    message=f"Device created successfully: {doc.name}"
-                )
-                
-                return {
-                    "status": "success",
-                    "message": "Device registered successfully",
-                    "device": doc.name
-                }
-            except Exception as create_error:
-                frappe.log_error(
-                    title="Device Registration - Create Error",
-                    message=f"Error creating device: {str(create_error)}\nTraceback: {traceback.format_exc()}\nData: {device_data}"
-                )
-                raise
+        device_data = map_device_info(device_info)
+        existing = get_existing_devices([device_data["device_id"]]).get(device_data["device_id"])
+        result = upsert_device(device_data, existing)
+        frappe.db.commit()
+        return result
 
     except frappe.ValidationError as e:
         frappe.db.rollback()
-        frappe.log_error(
-            title="Device Registration - Validation Error",
-            message=f"Validation error: {str(e)}\nTraceback: {traceback.format_exc()}\nDevice Info: {device_info}"
-        )
+        trace("Device Registration - Validation Error", f"Validation error: {str(e)}\nDevice Info: {device_info}")
         return {
             "status": "error",
             "message": str(e)
@@ -182,4 +55,168 @@ def register_device(device_info):
         return {
             "status": "error",
             "message": "An error occurred while registering the device. Please try again later."
-        }
\ No newline at end of file
+        }
+
+@frappe.whitelist()
+def register_devices(devices):
+    """
+    Register or refresh several devices in one call.
+
+    Args:
+        devices (list): `device_info` dicts as accepted by `register_device`
+
+    Returns:
+        dict: Overall status and one `register_device` style result per
+            device, in the same order, each with its `deviceId`
+    """
+    try:
+        if not isinstance(devices, list):
+            devices = frappe.parse_json(devices)
+
+        mapped = []
+        for device_info in devices:
+            try:
+                mapped.append(map_device_info(device_info))
+            except frappe.ValidationError as e:
+                mapped.append(e)
+
+        # One query for every device that is already registered
+        existing = get_existing_devices([d["device_id"] for d in mapped if isinstance(d, dict)])
+
+        results = []
+        for device_info, device_data in zip(devices, mapped):
+            device_id = device_info.get("deviceId") if isinstance(device_info, dict) else None
+            if isinstance(device_data, Exception):
+                results.append({"deviceId": device_id, "status": "error", "message": str(device_data)})
+                continue
+
+            try:
+                result = upsert_device(device_data, existing.get(device_data["device_id"]))
+            except frappe.ValidationError as e:
+                result = {"status": "error", "message": str(e)}
+            results.append({"deviceId": device_id, **result})
+
+        frappe.db.commit()
+        return {
+            "status": "success",
+            "devices": results
+        }
+
+    except Exception as e:
+        frappe.db.rollback()
+        frappe.log_error(
+            title="Device Registration - General Error",
+            message=f"Unexpected error: {str(e)}\nTraceback: {traceback.format_exc()}\nDevices: {devices}\nUser: {frappe.session.user}"
+        )
+        return {
+            "status": "error",
+            "message": "An error occurred while registering the devices. Please try again later."
+        }
+
+def map_device_info(device_info):
+    """
+    Validate a registration payload and map it to User Device fields.
+    """
+    if not isinstance(device_info, dict):
+        device_info = frappe.parse_json(device_info)
+
+    # Validate required fields
+    required_fields = ['deviceId', 'fcmToken', 'platform']
+    for field in required_fields:
+        if not device_info.get(field):
+            frappe.throw(_("Missing required field: {0}").format(field))
+
+    # Validate platform
+    platform = device_info.get('platform')
+    if platform.lower() not in ['android', 'ios']:
+        frappe.throw(_("Platform must be either 'android' or 'ios'"))
+
+    # Map the incoming data to DocType fields
+    return {
+        "user": frappe.session.user,
+        "device_id": device_info.get('deviceId'),
+        "device_token": device_info.get('fcmToken'),
+        "device_name": device_info.get('deviceName'),
+        "device_model": device_info.get('deviceModel'),
+        "os_version": device_info.get('osVersion'),
+        "platform": platform.lower()
+    }
+
+def get_existing_devices(device_ids):
+    """
+    Return `{device_id: device}` for the registered devices among `device_ids`.
+    """
+    if not device_ids:
+        return {}
+
+    devices = frappe.get_all(
+        "User Device",
+        filters={"device_id": ["in", device_ids]},
+        fields=["name", "disabled", *DEVICE_FIELDS]
+    )
+    return {device.device_id: device for device in devices}
+
+def upsert_device(device_data, existing=None):
+    """
+    Insert a device, update the fields that changed, or do nothing.
+    """
+    if not existing:
+        doc = frappe.get_doc({
+            "doctype": "User Device",
+            **device_data
+        })
+        frappe.db.savepoint("register_device")
+        try:
+            doc.insert()
+        except frappe.UniqueValidationError:
+            # Registered concurrently; the unique device_id index kept it single
+            frappe.db.rollback(save_point="register_device")
+            existing = get_existing_devices([device_data["device_id"]]).get(device_data["device_id"])
+            if not existing:
+                raise
+            return upsert_device(device_data, existing)
+
+        enqueue_device_topic_sync(doc.name)
+        trace("Device Registration - Create Success", f"Device created successfully: {doc.name}")
+        return {
+            "status": "success",
+            "message": "Device registered successfully",
+            "device": doc.name
+        }
+
+    changes = {field: value for field, value in device_data.items() if existing.get(field) != value}
+    if cint(existing.get("disabled")):
+        # A registering app proves its token alive, even if it was pruned
+        changes["disabled"] = 0
+    if not changes:
+        # Apps re-register on every start; most of the time nothing changed
+        return {
+            "status": "success",
+            "message": "Device is up to date",
+            "device": existing.name
+        }
+
+    frappe.has_permission("User Device", "write", throw=True)
+    resubscribe = "device_token" in changes or "disabled" in changes
+    if resubscribe:
+        # Subscriptions and the dead-token flag belong to the old (or pruned) token
+        changes["topics"] = None
+        changes["disabled"] = 0
+
+    frappe.db.set_value("User Device", existing.name, changes)
+    if resubscribe:
+        enqueue_device_topic_sync(existing.name)
+
+    trace("Device Registration - Update Success", f"Device updated: {existing.name}\nChanges: {changes}")
+    return {
+        "status": "success",
+        "message": "Device updated successfully",
+        "device": existing.name
+    }
+
+def trace(title, message):
+    """
+    Log a registration step to the Error Log, if enabled in FCM Notification Settings.
+    """
+    if cint(frappe.get_cached_doc("FCM Notification Settings").debug_device_registration):
+        frappe.log_error(title=title, message=message)
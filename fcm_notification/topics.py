@@ -0,0 +1,197 @@
+import json
+import re
+
+import frappe
+from frappe.utils import cint
+
+from fcm_notification.oauth import get_access_token
+from fcm_notification.transport import get_headers, get_transport
+
+IID_BATCH_ADD_URL = "https://iid.googleapis.com/iid/v1:batchAdd"
+IID_BATCH_REMOVE_URL = "https://iid.googleapis.com/iid/v1:batchRemove"
+# Instance ID accepts at most 1000 tokens per batch request
+IID_BATCH_SIZE = 1000
+
+# Roles every user has; a topic for them would just duplicate the site topic
+AUTOMATIC_ROLES = ("All", "Guest", "Desk User")
+
+def is_topic_broadcast_enabled():
+    return cint(frappe.get_cached_doc("FCM Notification Settings").use_topic_broadcast)
+
+def get_site_topic():
+    """
+    Topic every device of this site is subscribed to.
+    """
+    topic = frappe.get_cached_doc("FCM Notification Settings").broadcast_topic
+    return scrub_topic(topic or f"site-{frappe.local.site}")
+
+def get_role_topic(role):
+    return scrub_topic(f"{get_site_topic()}-role-{frappe.scrub(role)}")
+
+def scrub_topic(topic):
+    """
+    Replace characters FCM does not allow in topic names.
+    """
+    return re.sub(r"[^a-zA-Z0-9\-_.~%]", "-", topic)
+
+def get_user_topics(user, roles=None):
+    """
+    Topics the devices of `user` should be subscribed to.
+    """
+    topics = [get_site_topic()]
+    if cint(frappe.get_cached_doc("FCM Notification Settings").subscribe_role_topics):
+        for role in roles if roles is not None else frappe.get_roles(user):
+            if role not in AUTOMATIC_ROLES:
+                topics.append(get_role_topic(role))
+    return topics
+
+def get_stored_topics(device):
+    return set(filter(None, (device.topics or "").split("\n")))
+
+def enqueue_device_topic_sync(device):
+    """
+    Queue a subscription update for a registered device, if topics are in use.
+    """
+    if not is_topic_broadcast_enabled():
+        return
+
+    frappe.enqueue(
+        "fcm_notification.topics.sync_device_topics",
+        queue="short",
+        enqueue_after_commit=True,
+        device=device
+    )
+
+def sync_device_topics(device):
+    """
+    Background job: bring the topic subscriptions of one User Device up to date.
+    """
+    device = frappe.db.get_value("User Device", device, ["name", "user", "device_token", "topics", "disabled"], as_dict=True)
+    if not device or device.disabled:
+        return
+
+    current = get_stored_topics(device)
+    desired = set(get_user_topics(device.user))
+
+    for topic in desired - current:
+        if not batch_subscribe(topic, [device.device_token]):
+            current.add(topic)
+    for topic in current - desired:
+        if not batch_subscribe(topic, [device.device_token], unsubscribe=True):
+            current.discard(topic)
+
+    frappe.db.set_value("User Device", device.name, "topics", "\n".join(sorted(current)), update_modified=False)
+    frappe.db.commit()
+
+def unsubscribe_device(token, topics):
+    """
+    Background job: remove a deleted device from its topics.
+    """
+    for topic in filter(None, topics.split("\n")):
+        batch_subscribe(topic, [token], unsubscribe=True)
+
+def enqueue_topic_reconcile():
+    """
+    Queue a reconcile now instead of waiting for the daily one.
+    """
+    frappe.enqueue(
+        "fcm_notification.topics.reconcile_topic_subscriptions",
+        queue="long",
+        job_id=f"fcm_notification:reconcile_topics:{frappe.local.site}",
+        deduplicate=True,
+        enqueue_after_commit=True
+    )
+
+def reconcile_topic_subscriptions():
+    """
+    Scheduled job: keep topic membership in sync with User Device.
+
+    Subscriptions are diffed against what is recorded on each device, so only
+    the changes (new devices, role changes, failed earlier attempts) are sent
+    to the Instance ID API, grouped into batch requests per topic.
+    """
+    if not is_topic_broadcast_enabled():
+        return
+
+    devices = frappe.get_all("User Device", fields=["name", "user", "device_token", "topics", "disabled"])
+    roles_by_user = {}
+    to_add, to_remove = {}, {}
+    topics_by_device = {}
+
+    for device in devices:
+        if device.user not in roles_by_user:
+            roles_by_user[device.user] = frappe.get_roles(device.user)
+
+        current = get_stored_topics(device)
+        if device.disabled:
+            # FCM drops dead tokens from their topics by itself
+            if current:
+                frappe.db.set_value("User Device", device.name, "topics", None, update_modified=False)
+            continue
+
+        desired = set(get_user_topics(device.user, roles_by_user[device.user]))
+        if current == desired:
+            continue
+
+        for topic in desired - current:
+            to_add.setdefault(topic, []).append(device)
+        for topic in current - desired:
+            to_remove.setdefault(topic, []).append(device)
+        topics_by_device[device.name] = current
+
+    for topic, members in to_add.items():
+        failed = set(batch_subscribe(topic, [d.device_token for d in members]))
+        for device in members:
+            if device.device_token not in failed:
+                topics_by_device[device.name].add(topic)
+
+    for topic, members in to_remove.items():
+        failed = set(batch_subscribe(topic, [d.device_token for d in members], unsubscribe=True))
+        for device in members:
+            if device.device_token not in failed:
+                topics_by_device[device.name].discard(topic)
+
+    for name, topics in topics_by_device.items():
+        frappe.db.set_value("User Device", name, "topics", "\n".join(sorted(topics)), update_modified=False)
+    frappe.db.commit()
+
+def batch_subscribe(topic, tokens, unsubscribe=False):
+    """
+    Add `tokens` to (or remove them from) `topic` through the Instance ID API.
+
+    Returns:
+        list: tokens that could not be (un)subscribed
+    """
+    access_token = get_access_token()
+    transport = get_transport()
+    url = IID_BATCH_REMOVE_URL if unsubscribe else IID_BATCH_ADD_URL
+    headers = get_headers(access_token["token"])
+    headers["access_token_auth"] = "true"
+
+    failed = []
+    for start in range(0, len(tokens), IID_BATCH_SIZE):
+        chunk = tokens[start:start + IID_BATCH_SIZE]
+        try:
+            response = transport.post(url, headers, json.dumps({
+                "to": f"/topics/{topic}",
+                "registration_tokens": chunk
+            }))
+        except Exception as e:
+            response = None
+            error = str(e)
+        else:
+            error = f"{response.status_code} - {response.text}"
+
+        if response is None or response.status_code != 200:
+            frappe.log_error(
+                f"Error updating FCM topic {topic}: {error}",
+                "FCM Topic Subscription"
+            )
+            failed.extend(chunk)
+            continue
+
+        for token, result in zip(chunk, response.json().get("results", [])):
+            if result.get("error"):
+                failed.append(token)
+
+    return failed
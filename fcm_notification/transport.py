@@ -0,0 +1,98 @@
+import os
+
+import frappe
+import requests
+from frappe.utils import cint, flt
+from requests.adapters import HTTPAdapter
+
+FCM_SEND_URL = "https://fcm.googleapis.com/v1/projects/{project_id}/messages:send"
+
+# Defaults, overridable in FCM Notification Settings
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 10
+
+# One transport per process, rebuilt when the settings change or after a fork
+_transport = None
+
+class FCMTransport:
+    """
+    Keep-alive, connection pooled HTTP client for the FCM v1 API.
+
+    Uses a `requests.Session` by default. With `http2` enabled and `httpx[http2]`
+    installed, requests are multiplexed over HTTP/2 instead.
+    """
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT, http2=False):
+        self.options = (pool_size, connect_timeout, read_timeout, http2)
+        self.pid = os.getpid()
+        self.timeout = (connect_timeout, read_timeout)
+        self.http2 = http2 and has_http2()
+
+        if self.http2:
+            import httpx
+
+            self.client = httpx.Client(
+                http2=True,
+                limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout)
+            )
+        else:
+            self.client = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+            # Plain HTTP only ever reaches local mocks, e.g. the benchmarks
+            self.client.mount("https://", adapter)
+            self.client.mount("http://", adapter)
+
+    def post(self, url, headers, body):
+        """
+        POST `body` (already serialized) and return the response.
+        """
+        if self.http2:
+            return self.client.post(url, headers=headers, content=body)
+        return self.client.post(url, headers=headers, data=body, timeout=self.timeout)
+
+    def close(self):
+        self.client.close()
+
+def get_transport():
+    """
+    Return the transport for this process, creating it on first use.
+    """
+    global _transport
+
+    settings = frappe.get_cached_doc("FCM Notification Settings")
+    options = (
+        cint(settings.pool_size) or DEFAULT_POOL_SIZE,
+        flt(settings.connect_timeout) or DEFAULT_CONNECT_TIMEOUT,
+        flt(settings.read_timeout) or DEFAULT_READ_TIMEOUT,
+        bool(settings.use_http2)
+    )
+
+    if _transport and (_transport.options != options or _transport.pid != os.getpid()):
+        # Never reuse sockets inherited from a parent process
+        if _transport.pid == os.getpid():
+            _transport.close()
+        _transport = None
+
+    if not _transport:
+        _transport = FCMTransport(*options)
+
+    return _transport
+
+def get_send_url(project_id):
+    return FCM_SEND_URL.format(project_id=project_id)
+
+def get_headers(access_token):
+    return {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json; UTF-8",
+    }
+
+def has_http2():
+    try:
+        import h2  # noqa: F401
+        import httpx  # noqa: F401
+    except ImportError:
+        return False
+    return True